@@ -0,0 +1,131 @@
+import os
+import sys
+import numpy as np
+from scipy import ndimage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import functions as func
+
+
+def MakeVesselTree(generations=6, seed=None, root=(0, 0, 150), length=16, radius=2, step=0.5, spread=0.6):
+    '''
+    Random binary vessel tree: every tube splits into two thinner, shorter tubes at its end
+    Parameters:
+        generations (int): number of branching generations (2**generations - 1 tubes)
+        seed (int): random seed
+        root (array): 1x3 start position of the root tube in registration space (mm)
+        length (float): length of the root tube (mm), children are 0.75 times as long as their parent
+        radius (float): radius of the root tube (mm), children are 0.75 times as wide as their parent
+        step (float): centerline point spacing (mm)
+        spread (float): branching angle (radians) between a child and its parent direction
+    Returns:
+        array: nx3 array of centerline points
+        array: nx1 array of the radius of each point
+        array: (t+1) array of offsets, the points of tube k are points[offsets[k]:offsets[k+1]]
+    '''
+    rng = np.random.default_rng(seed)
+    points = []
+    radii = []
+    offsets = [0]
+    tubes = [(np.asarray(root, dtype=float), np.array([0, 1.0, 0]), length, radius)]
+    for generation in range(generations):
+        children = []
+        for start, direction, tubeLength, tubeRadius in tubes:
+            count = max(int(tubeLength/step), 2)
+            # gently curved centerline: the direction drifts a little at every step
+            drift = np.cumsum(rng.normal(scale=0.02, size=(count, 3)), axis=0)
+            directions = direction + drift
+            directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+            tube = start + np.cumsum(directions*step, axis=0)
+            points.append(tube)
+            radii.append(np.linspace(tubeRadius, 0.85*tubeRadius, count))
+            offsets.append(offsets[-1] + count)
+            end = directions[-1]
+            # rotate the end direction about a random axis perpendicular to it, once per side
+            axis = np.cross(end, rng.normal(size=3))
+            axis /= np.linalg.norm(axis)
+            for sign in (-1, 1):
+                angle = sign*spread*rng.uniform(0.7, 1.3)
+                child = end*np.cos(angle) + np.cross(axis, end)*np.sin(angle)
+                children.append((tube[-1], child, 0.75*tubeLength, 0.75*tubeRadius))
+        tubes = children
+    return np.vstack(points), np.concatenate(radii), np.array(offsets, dtype=np.int64)
+
+
+def MakeEmitterGeometry(count=29, pitch=5, height=650, offset=(0, 0)):
+    '''
+    geo.txt-like emitter positions of a linear stationary source array above the detector
+    Parameters:
+        count (int): number of emitter positions
+        pitch (float): distance between neighbouring emitters (mm)
+        height (float): distance between the source array and the detector (mm)
+        offset (array): x, y position of the center of the source array (mm)
+    Returns:
+        array: ex3 array of emitter positions, as returned by functions.ReadEmitterGeometry
+    '''
+    x = (np.arange(count) - (count-1)/2)*pitch + offset[0]
+    return np.stack([x, np.full(count, float(offset[1])), np.full(count, float(height))], axis=1)
+
+
+def WriteEmitterGeometry(path, y):
+    '''
+    Write emitter positions in the geo.txt layout read by functions.ReadEmitterGeometry (the first line is the fit)
+    '''
+    with open(path, 'w') as f:
+        f.write("0 0 0\n")
+        for line in y:
+            f.write("{:.6f} {:.6f} {:.6f}\n".format(*line))
+
+
+def RenderProjections(x, points, radii, y, size, spacing, intensity=4000, sigma=1.5):
+    '''
+    Render masked tomosynthesis projections of a vessel tree the way MakeVesselOverlay draws the vessels:
+    every centerline point is projected for every emitter position and painted with a footprint of its
+    magnified radius, then the masks are smoothed and scaled to vessel intensities
+    Parameters:
+        x (array): 1x6 pose of the vessels (x translation, y translation, z translation, z rotation, y rotation, x rotation)
+        points (array): nx3 array of centerline points
+        radii (array): nx1 array of the radius of each point
+        y (array): ex3 array of emitter positions
+        size (array): 1x3 array of pixel dimensions of the projection images
+        spacing (float): CT spacing used to scale the points to pixels
+        intensity (float): vessel intensity, below the 6000 reference of the registration residuals
+        sigma (float): Gaussian sigma in pixels
+    Returns:
+        array: read-only (e, H, W) float32 projection stack
+    '''
+    ProjP, EmitterPositions = func.CTProjectionTransform(y)
+    transformed = func.TransformAllPointsAllParameters(x, points)
+    projected, _, t = ProjP.TransformPointsMultiEmitter(transformed, EmitterPositions)
+    projected = projected/(spacing*0.194) + np.array([size[0]/2, size[1]/2])
+    halfSize = np.maximum(np.ceil(np.asarray(radii)*(1-t)/(spacing*0.194)), 1)
+    masks = func.RasterizePoints(projected, size, (halfSize, halfSize), value=1)
+    stack = ndimage.gaussian_filter(masks.astype(np.float32), sigma=(0, sigma, sigma))*intensity
+    stack.flags.writeable = False
+    return stack
+
+
+def MakePhantom(seed=0, generations=6, emitters=29, size=(1024, 1024), spacing=0.7, x_true=None):
+    '''
+    Complete synthetic registration problem
+    Parameters:
+        seed (int): random seed of the vessel tree
+        generations (int): branching generations of the vessel tree
+        emitters (int): number of emitter positions
+        size (array): pixel dimensions of the projection images (columns, rows)
+        spacing (float): CT spacing
+        x_true (array): 1x6 pose the projections are rendered with, defaults to a small offset from the identity
+    Returns:
+        dict: 'points', 'radii', 'offsets' (vessel tree), 'y' (emitter positions), 'stack' (masked projections),
+              'size', 'spacing', 'x_true' and 'x_scale' (parameter scales for least_squares)
+    '''
+    if x_true is None:
+        x_true = np.array([2.0, -1.5, 1.0, 0.02, -0.01, 0.015])
+    points, radii, offsets = MakeVesselTree(generations, seed)
+    # center the tree over the detector
+    points = points - np.array([points[:, 0].mean(), points[:, 1].mean(), 0])
+    y = MakeEmitterGeometry(emitters)
+    stack = RenderProjections(x_true, points, radii, y, size, spacing)
+    return {'points': points, 'radii': radii, 'offsets': offsets, 'y': y, 'stack': stack, 'size': tuple(size),
+            'spacing': spacing, 'x_true': np.asarray(x_true, dtype=float),
+            'x_scale': np.array([1, 1, 1, 100, 100, 100], dtype=float)}
@@ -0,0 +1,192 @@
+'''
+Timed benchmarks of the registration pipeline on a synthetic phantom, written as JSON so that speed and
+accuracy can be compared between commits and machines
+
+    python Benchmarks/run_benchmarks.py --output Results/benchmarks.json
+    python Benchmarks/run_benchmarks.py --quick --only objective registration
+    python Benchmarks/run_benchmarks.py --quick --profile Results/profile
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import scipy
+from scipy.optimize import least_squares
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import functions as func
+from imagewriter import ImageWriter
+import phantom
+import profiling
+
+
+def Time(fun, repeat, warmup=1):
+    '''
+    Run fun warmup times untimed, then repeat times
+    Returns:
+        dict: min, median and mean wall clock seconds of the timed runs, and the last return value under 'value'
+    '''
+    for _ in range(warmup):
+        value = fun()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = fun()
+        times.append(time.perf_counter() - start)
+    return {'repeat': repeat, 'min': min(times), 'median': float(np.median(times)), 'mean': float(np.mean(times)),
+            'value': value}
+
+
+def BenchTransformPoint(P, repeat):
+    ProjP, EmitterPositions = func.CTProjectionTransform(P['y'])
+    points = func.TransformAllPointsAllParameters(P['x_true'], P['points'])
+    result = Time(lambda: [ProjP.TransformPoint(point) for point in points], repeat)
+    return result, {'points': len(points)}
+
+
+def BenchTransformAllPoints(P, repeat):
+    result = Time(lambda: func.TransformAllPointsAllParameters(P['x_true'], P['points']), repeat)
+    return result, {'points': len(P['points'])}
+
+
+def BenchGetProjectedPointsCTTP(P, repeat):
+    ProjP, _ = func.CTProjectionTransform(P['y'])
+    points = func.TransformAllPointsAllParameters(P['x_true'], P['points'])
+    result = Time(lambda: func.GetProjectedPointsCTTP(points, ProjP, P['size'], P['spacing']), repeat)
+    return result, {'points': len(points)}
+
+
+def BenchMakeVesselMask(P, repeat):
+    # tomoRecon points: the phantom in mm, moved to the detector center the way ProjectTRPoints expects
+    size = P['size']
+    source = P['points'] + np.array([(size[0]/2)*0.194, (size[1]/2)*0.194, 0])
+    with tempfile.TemporaryDirectory() as destDir, ImageWriter(backend='serial') as writer:
+        result = Time(lambda: func.MakeVesselMask(P['y'], source, size, destDir, writer), repeat)
+    return result, {'points': len(source), 'emitters': len(P['y'])}
+
+
+def BenchObjective(P, repeat, stride=5):
+    u = P['points'][::stride]
+    x = P['x_true']*P['x_scale']
+    args = (u, P['y'], P['stack'], P['x_scale'], P['size'], P['spacing'])
+    result = Time(lambda: func.CT_TomoProjectionRegistration(x, *args), repeat)
+    return result, {'points': len(u), 'emitters': len(P['y'])}
+
+
+def BenchResiduals(P, repeat, stride=5):
+    u = P['points'][::stride]
+    x = P['x_true']*P['x_scale']
+    args = (u, P['y'], P['stack'], P['x_scale'], P['size'], P['spacing'])
+
+    def Evaluate():
+        func.CT_TomoProjectionRegistrationResiduals(x, *args)
+        return func.CT_TomoProjectionRegistrationResidualsJacobian(x, *args)
+    result = Time(Evaluate, repeat)
+    return result, {'points': len(u), 'emitters': len(P['y'])}
+
+
+def Accuracy(P, x):
+    error = np.asarray(x) - P['x_true']
+    return {'translation_error_mm': float(np.linalg.norm(error[0:3])),
+            'rotation_error_rad': float(np.linalg.norm(error[3:6])),
+            'solution': np.asarray(x).tolist()}
+
+
+def BenchRegistration(P, repeat, stride=5):
+    u = P['points'][::stride]
+    args = (u, P['y'], P['stack'], P['x_scale'], P['size'], P['spacing'])
+    result = Time(lambda: least_squares(func.CT_TomoProjectionRegistrationResiduals, np.zeros(6),
+                                        jac=func.CT_TomoProjectionRegistrationResidualsJacobian, args=args),
+                  repeat, warmup=0)
+    res = result['value']
+    extra = {'points': len(u), 'nfev': int(res.nfev), 'cost': float(res.cost)}
+    extra.update(Accuracy(P, res.x/P['x_scale']))
+    return result, extra
+
+
+def BenchPyramidRegistration(P, repeat):
+    levels = [{'factor': 4, 'stride': 10}, {'factor': 1, 'stride': 5}]
+    result = Time(lambda: func.PyramidRegistration(np.zeros(6), P['points'], P['y'], P['stack'], P['x_scale'],
+                                                   P['size'], P['spacing'], levels=levels),
+                  repeat, warmup=0)
+    res, results = result['value']
+    extra = {'levels': levels, 'nfev': [int(level.nfev) for level in results], 'cost': float(res.cost)}
+    extra.update(Accuracy(P, res.x/P['x_scale']))
+    return result, extra
+
+
+BENCHMARKS = {
+    'transform_point': BenchTransformPoint,
+    'transform_all_points': BenchTransformAllPoints,
+    'get_projected_points_cttp': BenchGetProjectedPointsCTTP,
+    'make_vessel_mask': BenchMakeVesselMask,
+    'objective': BenchObjective,
+    'residuals_jacobian': BenchResiduals,
+    'registration': BenchRegistration,
+    'pyramid_registration': BenchPyramidRegistration,
+}
+
+
+def Environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help="JSON file to write, printed to stdout by default")
+    parser.add_argument('--append', help="JSONL history file to append the results to")
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help="benchmarks to run")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs per benchmark")
+    parser.add_argument('--seed', type=int, default=0, help="phantom random seed")
+    parser.add_argument('--generations', type=int, default=6, help="phantom vessel tree generations")
+    parser.add_argument('--quick', action='store_true', help="smaller phantom and fewer repeats")
+    parser.add_argument('--profile', help="prefix of the profiling files (report, speedscope, cProfile) of the run, "
+                        "the timings then include the profiling overhead")
+    args = parser.parse_args(argv)
+    repeat = args.repeat
+    generations = args.generations
+    size = (1024, 1024)
+    if args.quick:
+        repeat, generations, size = 2, min(generations, 5), (512, 512)
+    P = phantom.MakePhantom(seed=args.seed, generations=generations, size=size)
+    report = {'environment': Environment(),
+              'phantom': {'seed': args.seed, 'generations': generations, 'points': len(P['points']),
+                          'emitters': len(P['y']), 'size': list(P['size']), 'x_true': P['x_true'].tolist()},
+              'benchmarks': {}}
+    if args.profile:
+        profile = profiling.Start(args.profile, cprofile=True)
+    for name in args.only or BENCHMARKS:
+        result, extra = BENCHMARKS[name](P, repeat)
+        del result['value']
+        result.update(extra)
+        report['benchmarks'][name] = result
+        print("{:28s} median {:.6f} s".format(name, result['median']), file=sys.stderr)
+    if args.profile:
+        profiling.Stop()
+        report['profile'] = profile.Stats()
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.append:
+        with open(args.append, 'a') as f:
+            f.write(json.dumps(report) + "\n")
+    return report
+
+
+if __name__ == '__main__':
+    main()
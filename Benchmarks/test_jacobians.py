@@ -0,0 +1,156 @@
+'''
+Finite difference checks of the analytic Jacobians on a small synthetic phantom.
+
+Run with pytest from the repository root, or directly:
+    python Benchmarks/test_jacobians.py
+'''
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import functions as func
+import compact
+import phantom
+import PythonRigid3DTransform as R
+
+
+def SmallPhantom():
+    P = phantom.MakePhantom(seed=1, generations=4, emitters=5, size=(160, 160), spacing=0.7)
+    P['u'] = P['points'][::3]
+    # away from the rendered pose, so the points sample the slopes of the vessels
+    P['x'] = (P['x_true'] + np.array([0.3, -0.2, 0.1, 0.002, 0.001, -0.002]))*P['x_scale']
+    return P
+
+
+def CentralDifferences(fun, x, step=1e-4):
+    '''
+    Returns:
+        array: mx6 central difference Jacobian of the m-vector function fun at x
+    '''
+    columns = []
+    for k in range(len(x)):
+        h = np.zeros(len(x))
+        h[k] = step
+        columns.append((fun(x + h) - fun(x - h))/(2*step))
+    return np.stack(columns, axis=1)
+
+
+def RelativeError(analytic, numeric):
+    return np.linalg.norm(analytic - numeric)/np.linalg.norm(numeric)
+
+
+def VersorMatrix(versor):
+    '''
+    Returns:
+        array: 3x3 rotation of the unit versor whose vector part is versor (scalar part from the unit norm)
+    '''
+    x, y, z = versor
+    w = np.sqrt(1 - np.dot(versor, versor))
+    return np.array([[1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)],
+                     [2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)],
+                     [2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)]])
+
+
+def test_position_jacobian():
+    # d(uv)/d(point) of TransformPointsMultiEmitter, every emitter position
+    P = SmallPhantom()
+    ProjP, EmitterPositions = func.CTProjectionTransform(P['y'])
+    points = func.TransformAllPointsAllParameters(P['x']/P['x_scale'], P['u'][:20])
+    analytic = ProjP.ComputeJacobianWithRespectToPositionMultiEmitter(points, EmitterPositions)
+    for k in range(3):
+        h = np.zeros(3)
+        h[k] = 1e-5
+        plus = ProjP.TransformPointsMultiEmitter(points + h, EmitterPositions)[0]
+        minus = ProjP.TransformPointsMultiEmitter(points - h, EmitterPositions)[0]
+        numeric = (plus - minus)/2e-5
+        assert RelativeError(analytic[..., k], numeric) < 1e-6
+
+
+def test_parameter_jacobian():
+    # versor (vx, vy, vz) and translation derivatives of the rigid transform at the rotation of the angles
+    center = np.array([1.0, -2.0, 3.0])
+    ProjP, _ = func.CTProjectionTransform(SmallPhantom()['y'])
+    ProjP.CenterOfRotation = center
+    angles = np.array([0.3, -0.2, 0.5])
+    point = np.array([10.0, -4.0, 7.0])
+    analytic = ProjP.ComputeJacobianWithRespectToParameters(angles, point)
+    rotation = R.RigidMatrices([0, 0, 0, angles[2], angles[1], angles[0]])[0, 0:3, 0:3]
+    # the unit versor of that rotation, vector part
+    w = np.sqrt(1 + np.trace(rotation))/2
+    versor = np.array([rotation[2, 1] - rotation[1, 2], rotation[0, 2] - rotation[2, 0],
+                       rotation[1, 0] - rotation[0, 1]])/(4*w)
+    assert np.allclose(VersorMatrix(versor), rotation)
+
+    def Transform(parameters):
+        return VersorMatrix(parameters[0:3]) @ (point - center) + center + parameters[3:6]
+    numeric = CentralDifferences(Transform, np.concatenate([versor, np.zeros(3)]), step=1e-6)
+    assert RelativeError(analytic, numeric) < 1e-6
+
+
+def test_projection_jacobian():
+    # chain of the rigid and perspective Jacobians, d(pixel)/d(x)
+    P = SmallPhantom()
+    x = P['x']/P['x_scale']
+    u = P['u'][:20]
+    analytic = func.ProjectCTPointsJacobian(x, u, P['y'], P['size'], P['spacing'])
+    numeric = CentralDifferences(lambda x: func.ProjectCTPoints(x, u, P['y'], P['size'], P['spacing']).ravel(), x,
+                                 step=1e-6)
+    assert RelativeError(analytic.reshape(-1, 6), numeric) < 1e-6
+
+
+def CheckResidualsJacobian(dtype):
+    P = SmallPhantom()
+    stack = compact.ToStackDtype(P['stack'], dtype)
+    args = (P['u'], P['y'], stack, P['x_scale'], P['size'], P['spacing'])
+    analytic = func.CT_TomoProjectionRegistrationResidualsJacobian(P['x'], *args)
+    numeric = CentralDifferences(lambda x: func.CT_TomoProjectionRegistrationResiduals(x, *args), P['x'])
+    assert np.linalg.norm(numeric) > 0
+    assert RelativeError(analytic, numeric) < 1e-6
+
+
+def test_residuals_jacobian_float32():
+    CheckResidualsJacobian(np.float32)
+
+
+def test_residuals_jacobian_uint16():
+    # compact stacks: differences of the uint16 corner samples must not wrap around
+    CheckResidualsJacobian(np.uint16)
+
+
+def test_masked_stack_jacobian_under_budget():
+    # the batch runner gives MaskedProjectionStack half of --memory-gb, which selects uint16 for the whole number
+    # raw projections; the Jacobian based methods register on that stack
+    P = SmallPhantom()
+    size = P['size']
+    # annotation points every 10x12 pixels on the detector plane, their rectangles cover the whole image
+    cols, rows = np.meshgrid(np.arange(0, size[0] + 10, 10), np.arange(0, size[1] + 12, 12))
+    annotations = np.stack([cols.ravel()*0.194, rows.ravel()*0.194, np.zeros(cols.size)], axis=1)
+    raw = [np.fliplr(np.round(image)) for image in P['stack']]
+    budget = compact.StackBytes(P['stack'].shape, np.float32)//2
+    stack = func.MaskedProjectionStack(raw, P['y'], annotations, size, memory_budget=budget)
+    assert stack.dtype == np.uint16
+    assert np.array_equal(stack, np.round(P['stack']))
+    args = (P['u'], P['y'], stack, P['x_scale'], size, P['spacing'])
+    analytic = func.CT_TomoProjectionRegistrationResidualsJacobian(P['x'], *args)
+    numeric = CentralDifferences(lambda x: func.CT_TomoProjectionRegistrationResiduals(x, *args), P['x'])
+    assert RelativeError(analytic, numeric) < 1e-6
+
+
+def test_fill_stack_keeps_fractions():
+    # the first image is whole numbers, a later one is not; uint16 would round it and float16 would quantize it
+    images = [np.full((4, 4), 3.0), np.full((4, 4), 5000.5)]
+    try:
+        compact.FillStack(iter(images), 2, memory_budget=compact.StackBytes((2, 4, 4), np.uint16))
+    except MemoryError:
+        pass
+    else:
+        raise AssertionError("a fractional stack over the float32 budget must not be stored compactly")
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print("{} passed".format(name))
@@ -0,0 +1,104 @@
+import functools
+import numpy as np
+
+
+def RigidMatrices(x):
+    '''
+    Compose the rotation in z, rotation in y, rotation in x and translation (applied in that order)
+    into a single 4x4 transformation matrix per parameter vector
+    Parameters:
+        x (array): Kx6 array where each row defines the x translation, y translation
+                   z translation, z rotation, y rotation and x rotation respectively
+    Returns:
+        array: Kx4x4 array of composed transformation matrices
+    '''
+    x = np.asarray(x, dtype=float).reshape(-1, 6)
+    cz, sz = np.cos(x[:, 3]), np.sin(x[:, 3])
+    cy, sy = np.cos(x[:, 4]), np.sin(x[:, 4])
+    cx, sx = np.cos(x[:, 5]), np.sin(x[:, 5])
+    matrices = np.zeros((len(x), 4, 4))
+    # Rx * Ry * Rz written out
+    matrices[:, 0, 0] = cy*cz
+    matrices[:, 0, 1] = -cy*sz
+    matrices[:, 0, 2] = sy
+    matrices[:, 1, 0] = sx*sy*cz + cx*sz
+    matrices[:, 1, 1] = -sx*sy*sz + cx*cz
+    matrices[:, 1, 2] = -sx*cy
+    matrices[:, 2, 0] = -cx*sy*cz + sx*sz
+    matrices[:, 2, 1] = cx*sy*sz + sx*cz
+    matrices[:, 2, 2] = cx*cy
+    # translation is applied last
+    matrices[:, 0:3, 3] = x[:, 0:3]
+    matrices[:, 3, 3] = 1
+    return matrices
+
+
+@functools.lru_cache(maxsize=256)
+def _CachedRigidMatrix(key):
+    matrix = RigidMatrices(key)[0]
+    matrix.flags.writeable = False
+    return matrix
+
+
+def RigidMatrix(x):
+    '''
+    Composed 4x4 transformation matrix for one parameter vector, cached on the parameter values
+    Parameters:
+        x (array): 1x6 array where the inputs define the x translation, y translation
+                   z translation, z rotation, y rotation and x rotation respectively
+    Returns:
+        array: read-only 4x4 transformation matrix
+    '''
+    return _CachedRigidMatrix(tuple(float(i) for i in np.ravel(x)))
+
+
+def TransformPoints(x, points):
+    '''
+    Transform 3D points with one matrix multiplication per parameter vector
+    Parameters:
+        x (array): 1x6 parameter vector, or Kx6 array of parameter vectors
+                   (x translation, y translation, z translation, z rotation, y rotation, x rotation)
+        points (array): nx3 array of 3D points to be transformed, float32 points are transformed in float32
+    Returns:
+        array: nx3 array of transformed 3D points, or Kxnx3 array when x is Kx6
+    '''
+    # float32 points stay float32 (compact mode), anything else is computed in float64
+    points = np.asarray(points)
+    dtype = np.float32 if points.dtype == np.float32 else np.float64
+    points = points.astype(dtype, copy=False)
+    if np.ndim(x) == 2:
+        matrices = RigidMatrices(x).astype(dtype)
+        return points @ matrices[:, 0:3, 0:3].transpose(0, 2, 1) + matrices[:, np.newaxis, 0:3, 3]
+    matrix = RigidMatrix(x).astype(dtype)
+    return points @ matrix[0:3, 0:3].T + matrix[0:3, 3]
+
+
+def RigidJacobian(x, points):
+    '''
+    Derivative of the transformed points with respect to the 6 parameters
+    Parameters:
+        x (array): 1x6 array where the inputs define the x translation, y translation
+                   z translation, z rotation, y rotation and x rotation respectively
+        points (array): nx3 array of 3D points
+    Returns:
+        array: nx3x6 array, column k is the derivative of the transformed point with respect to x[k]
+    '''
+    x = np.ravel(np.asarray(x, dtype=float))
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    cz, sz = np.cos(x[3]), np.sin(x[3])
+    cy, sy = np.cos(x[4]), np.sin(x[4])
+    cx, sx = np.cos(x[5]), np.sin(x[5])
+    rotationZ = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    rotationY = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rotationX = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    dRotationZ = np.array([[-sz, -cz, 0], [cz, -sz, 0], [0, 0, 0]])
+    dRotationY = np.array([[-sy, 0, cy], [0, 0, 0], [-cy, 0, -sy]])
+    dRotationX = np.array([[0, 0, 0], [0, -sx, -cx], [0, cx, -sx]])
+    jacobian = np.zeros((len(points), 3, 6))
+    jacobian[:, 0, 0] = 1
+    jacobian[:, 1, 1] = 1
+    jacobian[:, 2, 2] = 1
+    jacobian[:, :, 3] = points @ (rotationX @ rotationY @ dRotationZ).T
+    jacobian[:, :, 4] = points @ (rotationX @ dRotationY @ rotationZ).T
+    jacobian[:, :, 5] = points @ (dRotationX @ rotationY @ rotationZ).T
+    return jacobian
@@ -40,23 +40,69 @@ class VersorRigid3DPerspectiveTransform:
         # Intersection is a line if
         # (p01 x p02) * Iab == 1 
     
-        Ia = point
-        Ib = self.EmitterPosition
-        p0 = self.PlaneCenter
-        p01 = self.xDirection - p0
-        p02 = self.yDirection - p0
-        Iab = -(Ib - Ia)  ## actually storing -Iab, for convenience
+        transformed_point, pointOfIntersection, m_LastTransformedPointDistance = self.TransformPoints(
+            np.asarray(point, dtype=float).reshape(1, 3))
+        return transformed_point[0], pointOfIntersection[0], m_LastTransformedPointDistance[0]
+
+    def GetPlaneBasis(self):
+        # plane origin, plane axis directions and their normal (p01 x p02), shared by every projected point
+        p0 = np.asarray(self.PlaneCenter, dtype=float)
+        p01 = np.asarray(self.xDirection, dtype=float) - p0
+        p02 = np.asarray(self.yDirection, dtype=float) - p0
+        return p0, p01, p02, np.cross(p01, p02)
+
+    def TransformPoints(self, points):
+        # Vectorized TransformPoint: same line-plane intersection for an (N, 3) array of points
+        # Returns uv (N, 2), pointOfIntersection (N, 3) and t (N,)
+        transformed_points, pointOfIntersection, t = self.TransformPointsMultiEmitter(points, [self.EmitterPosition])
+        return transformed_points[0], pointOfIntersection[0], t[0]
+
+    def TransformPointsMultiEmitter(self, points, EmitterPositions):
+        # Project N points for E emitter positions sharing this detector plane in one call
+        # EmitterPositions is an (E, 3) array, returns uv (E, N, 2), pointOfIntersection (E, N, 3) and t (E, N)
+        # float32 points are projected in float32 (compact mode), anything else in float64
+        dtype = np.float32 if np.asarray(points).dtype == np.float32 else np.float64
+        Ia = np.asarray(points, dtype=dtype).reshape(-1, 3)
+        Ib = np.asarray(EmitterPositions, dtype=dtype).reshape(-1, 3)
+        p0, p01, p02, normal = (vector.astype(dtype) for vector in self.GetPlaneBasis())
+        Iab = Ia[np.newaxis, :, :] - Ib[:, np.newaxis, :]   ## actually storing -Iab, for convenience
         p0Ia = Ia - p0
-        transformed_point = np.array([0, 0])
-        denom = np.dot(Iab, np.cross(p01, p02))
-        transformed_point[0] = np.dot(np.cross(p02, Iab), p0Ia) /  denom
-        transformed_point[1] = np.dot(np.cross(Iab, p01), p0Ia) / denom
-
-        m_LastTransformedPointDistance = np.dot(np.cross(p01, p02), p0Ia) / denom
-        pointOfIntersection = Ia + Iab*m_LastTransformedPointDistance
+        denom = Iab @ normal
+        # (p02 x Iab) * p0Ia == Iab * (p0Ia x p02), so the per-point cross products are computed once for all emitters
+        transformed_points = np.empty(Iab.shape[:2] + (2,), dtype=dtype)
+        transformed_points[..., 0] = (Iab * np.cross(p0Ia, p02)).sum(axis=-1) / denom
+        transformed_points[..., 1] = (Iab * np.cross(p01, p0Ia)).sum(axis=-1) / denom
+
+        m_LastTransformedPointDistance = (p0Ia @ normal) / denom
+        pointOfIntersection = Ia + Iab*m_LastTransformedPointDistance[..., np.newaxis]
+        return transformed_points, pointOfIntersection, m_LastTransformedPointDistance
+
+    def ComputeJacobianWithRespectToPosition(self, points):
+        # Derivative of the projected uv with respect to the 3D point, (N, 2, 3)
+        return self.ComputeJacobianWithRespectToPositionMultiEmitter(points, [self.EmitterPosition])[0]
+
+    def ComputeJacobianWithRespectToPositionMultiEmitter(self, points, EmitterPositions):
+        # Derivative of the projected uv with respect to the 3D point for E emitter positions, (E, N, 2, 3)
+
+        # u = (Iab * (p0Ia x p02)) / denom, v = (Iab * (p01 x p0Ia)) / denom, denom = Iab * (p01 x p02)
+        # both Iab and p0Ia move with the point, so
+        # du/dIa = ((p0Ia x p02) + (p02 x Iab) - u * (p01 x p02)) / denom
+        # dv/dIa = ((p01 x p0Ia) + (Iab x p01) - v * (p01 x p02)) / denom
+        Ia = np.asarray(points, dtype=float).reshape(-1, 3)
+        Ib = np.asarray(EmitterPositions, dtype=float).reshape(-1, 3)
+        p0, p01, p02, normal = self.GetPlaneBasis()
+        Iab = Ia[np.newaxis, :, :] - Ib[:, np.newaxis, :]
+        p0Ia = Ia - p0
+        denom = (Iab @ normal)[..., np.newaxis]
+        crossU = np.cross(p0Ia, p02)
+        crossV = np.cross(p01, p0Ia)
+        u = (Iab * crossU).sum(axis=-1, keepdims=True) / denom
+        v = (Iab * crossV).sum(axis=-1, keepdims=True) / denom
+        jacobian = np.empty(Iab.shape[:2] + (2, 3))
+        jacobian[..., 0, :] = (crossU + np.cross(p02, Iab) - u * normal) / denom
+        jacobian[..., 1, :] = (crossV + np.cross(Iab, p01) - v * normal) / denom
+        return jacobian
 
-        return transformed_point, pointOfIntersection, m_LastTransformedPointDistance
-    
     def ComputeJacobianWithRespectToParameters(self, angles, point):
         # compute derivatives with respect to rotation
         x = angles[0]
@@ -66,16 +112,17 @@ class VersorRigid3DPerspectiveTransform:
         cz = math.cos(z*0.5)
         sz = math.sin(z*0.5)
         cy = math.cos(y*0.5)
-        sy = math.sin(z*0.5)
+        sy = math.sin(y*0.5)
         cx = math.cos(x*0.5)
-        sx = math.sin(z*0.5)
+        sx = math.sin(x*0.5)
 
+        # unit versor of the rotation Rx * Ry * Rz (rotation in z applied first), as in PythonRigid3DTransform
         vx = sx * cy * cz + cx * sy * sz
-        vy = cx * sy * cz + sx * cy * sz
+        vy = cx * sy * cz - sx * cy * sz
         vz = cx * cy * sz + sx * sy * cz
-        vw = cx * cy * cz + sx * sy * sz
+        vw = cx * cy * cz - sx * sy * sz
 
-        jacobian = np.empty([3, 6])
+        jacobian = np.zeros([3, 6])
 
         px = point[0] - self.CenterOfRotation[0]
         py = point[1] - self.CenterOfRotation[1]
@@ -0,0 +1,334 @@
+'''
+Register many patients from a manifest without the notebook: load, mask, register and overlay each patient
+in a process pool, checkpointing after every stage so an interrupted batch resumes where it stopped
+
+    python batchregistration.py manifest.json --cores-per-job 4 --memory-gb 16 --report Results/batch.json
+
+Manifest (JSON, relative paths are relative to the manifest):
+    {
+     "defaults": {"x_init": [0, 55, -25, 3.14159, 3.14159, 0], "method": "scalar"},
+     "patients": [
+      {"name": "02",
+       "tomo_proj_dir": "Data/TomoProjection_02", "overlay_dir": "Data/TomoAnnotation_02",
+       "geo_file": "Data/TomoProjection_02/geo.txt", "vessel_file": "Data/Vessels_02/CT-Lungs-Vessels_02.tre",
+       "ct_file": "Data/CT_02/CT_02_04.nii", "output_dir": "Results/02"}
+     ]
+    }
+Optional per patient (or in "defaults"): "method" ('scalar' as in the notebook, 'residuals', 'pyramid' or
+'global'), "x_scale", "point_stride" (default 100), "registration_stride" (default 5), "overlay_stride"
+(default 20), "overlay_chunk" (points projected at once for the overlay, default 65536), "half_width" (global search), "least_squares" (options passed to least_squares), "debug_images"
+(write the flipped, mask and masked images), "solution_output_filename" (default regSolution_<name>.txt)
+'''
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+STAGES = ('load', 'mask', 'register', 'overlay')
+
+# notebook settings, used unless the manifest overrides them
+DEFAULTS = {
+    'method': 'scalar',
+    'x_scale': [1/13000000, 1/13000000, 1/13000000, .000001, .000001, .000001],
+    'point_stride': 100,
+    'registration_stride': 5,
+    'overlay_stride': 20,
+    'overlay_chunk': 65536,
+    'half_width': [10, 10, 10, 0.1, 0.1, 0.1],
+    'least_squares': {},
+    'debug_images': False,
+}
+PATH_KEYS = ('tomo_proj_dir', 'overlay_dir', 'geo_file', 'vessel_file', 'ct_file', 'output_dir')
+
+# thread pool sizes of the BLAS, OpenMP and ITK libraries, set to cores_per_job in the workers
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS')
+
+
+def ReadManifest(manifest_file):
+    '''
+    Parse the manifest into one job dictionary per patient, defaults filled in and paths made absolute
+    Returns:
+        list: job dictionaries
+    '''
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    root = os.path.dirname(os.path.abspath(manifest_file))
+    defaults = dict(DEFAULTS)
+    defaults.update(manifest.get('defaults', {}))
+    jobs = []
+    for patient in manifest['patients']:
+        job = dict(defaults)
+        job.update(patient)
+        missing = [key for key in PATH_KEYS + ('name', 'x_init') if key not in job]
+        if missing:
+            raise ValueError("patient {} is missing {}".format(job.get('name'), ", ".join(missing)))
+        for key in PATH_KEYS:
+            job[key] = os.path.join(root, job[key])
+        job.setdefault('solution_output_filename', "regSolution_{}.txt".format(job['name']))
+        jobs.append(job)
+    return jobs
+
+
+def _ImageInformation(path):
+    # size and spacing from the image header, without reading the pixels (the CT volume is large)
+    import itk
+    imageIO = itk.ImageIOFactory.CreateImageIO(path, itk.CommonEnums.IOFileMode_ReadMode)
+    imageIO.SetFileName(path)
+    imageIO.ReadImageInformation()
+    dimension = imageIO.GetNumberOfDimensions()
+    return ([imageIO.GetDimensions(i) for i in range(dimension)], [imageIO.GetSpacing(i) for i in range(dimension)])
+
+
+class Checkpoint:
+    '''
+    Completed stages of one patient, stored as checkpoint.json in the patient's output directory
+    '''
+    def __init__(self, output_dir, force=False):
+        self.path = os.path.join(output_dir, "checkpoint.json")
+        self.stages = {}
+        if not force and os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.stages = json.load(f)['stages']
+
+    def Done(self, stage):
+        # a stage is done when it was recorded and every file it wrote still exists
+        record = self.stages.get(stage)
+        return record is not None and all(os.path.exists(path) for path in record.get('files', []))
+
+    def Record(self, stage, seconds, files=(), **fields):
+        self.stages[stage] = dict(seconds=seconds, files=list(files), **fields)
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'stages': self.stages}, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+def Register(job, source, y, stack, size, spacing):
+    '''
+    Run the registration method of the job
+    Returns:
+        array: 1x6 unscaled solution
+    '''
+    import functions as func
+    from scipy.optimize import least_squares
+    from memoize import MemoizedObjective
+    x_scale = np.asarray(job['x_scale'], dtype=float)
+    x0 = np.zeros(6)
+    u = source[1::job['registration_stride']]
+    options = dict(job['least_squares'])
+    method = job['method']
+    if method == 'scalar':
+        # notebook step 6
+        settings = dict(method='trf', tr_options={"regularize": False}, bounds=[-3, 3],
+                        diff_step=[0.9, 0.9, 0.9, 0.1, 0.1, 0.1], gtol=1e-15, xtol=1e-15)
+        settings.update(options)
+        objective = MemoizedObjective(func.CT_TomoProjectionRegistration, maxsize=256, tolerance=1e-9)
+        res = least_squares(objective, x0*x_scale, args=(u, y, stack, x_scale, size, spacing), **settings)
+    elif method == 'residuals':
+        settings = dict(method='trf', bounds=[-3, 3])
+        settings.update(options)
+        res = least_squares(func.CT_TomoProjectionRegistrationResiduals, x0*x_scale,
+                            jac=func.CT_TomoProjectionRegistrationResidualsJacobian,
+                            args=(u, y, stack, x_scale, size, spacing), **settings)
+    elif method == 'pyramid':
+        res, _ = func.PyramidRegistration(x0*x_scale, source, y, stack, x_scale, size, spacing, **options)
+    elif method == 'global':
+        res, _, _, _ = func.GlobalSearch(x0*x_scale, u, y, stack, x_scale, size, spacing, job['half_width'],
+                                         backend='serial', **options)
+    else:
+        raise ValueError("method must be 'scalar', 'residuals', 'pyramid' or 'global', got {}".format(method))
+    return res.x/x_scale
+
+
+def RunJob(job, force=False, memory_budget=None):
+    '''
+    Run (or resume) the pipeline of one patient
+    Parameters:
+        job (dict): one entry of ReadManifest
+        force (bool): ignore the checkpoint and run every stage
+        memory_budget (int): bytes the masked projection stack may use (see functions.LoadProjectionStack)
+    Returns:
+        dict: name, status ('done' or 'failed'), seconds per stage, solution and error
+    '''
+    import functions as func
+    import telemetry
+    output_dir = job['output_dir']
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = Checkpoint(output_dir, force)
+    summary = {'name': job['name'], 'status': 'done', 'stages': {}, 'resumed': [], 'pid': os.getpid()}
+    telemetry.Enable(os.path.join(output_dir, "telemetry.jsonl"))
+    try:
+        # load: always rerun, the centerlines come from their cache and the rest is small
+        start = time.perf_counter()
+        y = func.ReadEmitterGeometry(job['geo_file'])
+        points, radii, _ = func.LoadVesselCenterlines(job['vessel_file'])
+        source_points = points[:, [0, 2, 1]]
+        projections = sorted(glob.glob(os.path.join(job['tomo_proj_dir'], "Image_*.dcm")))
+        overlays = sorted(glob.glob(os.path.join(job['overlay_dir'], "overlayMask_*.dcm")))
+        size = _ImageInformation(projections[0])[0]
+        spacing = _ImageInformation(job['ct_file'])[1][0]
+        source = func.TransformAllPointsAllParameters(job['x_init'], source_points[1::job['point_stride']])
+        summary['stages']['load'] = time.perf_counter() - start
+
+        stack_file = os.path.join(output_dir, "maskedTomo_stack.npy")
+        if checkpoint.Done('mask'):
+            stack = np.load(stack_file, mmap_mode='r')
+            summary['resumed'].append('mask')
+        else:
+            start = time.perf_counter()
+            annotations = func.AnnotationsToPoints(overlays)
+            debugDir = None
+            if job['debug_images']:
+                debugDir = os.path.join(output_dir, "MaskedTomo")
+                os.makedirs(debugDir, exist_ok=True)
+            stack = func.MaskedProjectionStack(projections, y, annotations, size, debugDir,
+                                               memory_budget=memory_budget)
+            np.save(stack_file, stack)
+            summary['stages']['mask'] = time.perf_counter() - start
+            checkpoint.Record('mask', summary['stages']['mask'], [stack_file], dtype=stack.dtype.name)
+
+        solution_file = os.path.join(output_dir, job['solution_output_filename'])
+        if checkpoint.Done('register'):
+            solution = np.asarray(checkpoint.stages['register']['solution'])
+            summary['resumed'].append('register')
+        else:
+            start = time.perf_counter()
+            solution = Register(job, source, y, stack, size, spacing)
+            np.savetxt(solution_file, solution, delimiter=',')
+            summary['stages']['register'] = time.perf_counter() - start
+            checkpoint.Record('register', summary['stages']['register'], [solution_file], solution=solution.tolist(),
+                              method=job['method'])
+        summary['solution'] = np.asarray(solution).tolist()
+
+        overlay_dir = os.path.join(output_dir, "SolutionTomo")
+        if checkpoint.Done('overlay'):
+            summary['resumed'].append('overlay')
+        else:
+            start = time.perf_counter()
+            os.makedirs(overlay_dir, exist_ok=True)
+            stride = job['overlay_stride']
+            overlaySource = func.TransformAllPointsAllParameters(job['x_init'], source_points[1::stride])
+            transformed = func.TransformAllPointsAllParameters(solution, overlaySource)
+            func.MakeVesselOverlay(y, transformed, size, overlay_dir, spacing, radii=radii[1::stride],
+                                   chunk=job['overlay_chunk'])
+            summary['stages']['overlay'] = time.perf_counter() - start
+            checkpoint.Record('overlay', summary['stages']['overlay'], [overlay_dir])
+        telemetry.Report()
+    except Exception:
+        summary['status'] = 'failed'
+        summary['error'] = traceback.format_exc()
+    finally:
+        telemetry.Disable()
+    return summary
+
+
+def _InitWorker(cores, memory_limit):
+    # pin the worker to its own cores and cap its address space, one core set per worker
+    if cores is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores.get())
+    if memory_limit is not None:
+        try:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        except (ImportError, ValueError, OSError):
+            pass
+
+
+def RunBatch(jobs, cores_per_job=1, memory_gb=None, workers=None, force=False):
+    '''
+    Run the jobs in a process pool with one worker per cores_per_job cores
+    Parameters:
+        jobs (list): job dictionaries from ReadManifest
+        cores_per_job (int): cores (and BLAS threads) of each worker
+        memory_gb (float): address space limit of each worker, half of it is the budget of the projection stack
+        workers (int): number of workers, defaults to the available cores divided by cores_per_job
+        force (bool): ignore the checkpoints and rerun every stage
+    Returns:
+        list: one RunJob summary per job, in manifest order
+    '''
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    if workers is None:
+        workers = max(1, len(available)//cores_per_job)
+    workers = max(1, min(workers, len(jobs)))
+    memory_limit = int(memory_gb*2**30) if memory_gb else None
+    memory_budget = memory_limit//2 if memory_limit else None
+    # spawned workers start a fresh interpreter, so the thread limits apply to their BLAS and OpenMP pools; the
+    # calling process (e.g. a notebook kernel) gets its own values back once the pool is done
+    previous = {key: os.environ.get(key) for key in THREAD_VARIABLES}
+    os.environ.update({key: str(cores_per_job) for key in THREAD_VARIABLES})
+    try:
+        context = multiprocessing.get_context('spawn')
+        cores = None
+        if len(available) >= workers*cores_per_job:
+            cores = context.Queue()
+            for i in range(workers):
+                cores.put(set(available[i*cores_per_job:(i+1)*cores_per_job]))
+        summaries = [None]*len(jobs)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_InitWorker,
+                                 initargs=(cores, memory_limit)) as executor:
+            futures = {executor.submit(RunJob, job, force, memory_budget): i for i, job in enumerate(jobs)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    summaries[i] = future.result()
+                except Exception:
+                    # the worker itself died (e.g. out of memory)
+                    summaries[i] = {'name': jobs[i]['name'], 'status': 'failed', 'stages': {}, 'resumed': [],
+                                    'error': traceback.format_exc()}
+                summary = summaries[i]
+                print("{} {} ({:.1f} s)".format(summary['name'], summary['status'],
+                                                sum(summary['stages'].values())), file=sys.stderr)
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+    return summaries
+
+
+def Report(summaries, wall_seconds):
+    '''
+    Returns:
+        dict: per job summaries, and the total seconds per stage over all jobs
+    '''
+    totals = {stage: sum(summary['stages'].get(stage, 0) for summary in summaries) for stage in STAGES}
+    return {'wall_seconds': wall_seconds, 'jobs': summaries, 'stage_seconds': totals,
+            'done': sum(summary['status'] == 'done' for summary in summaries),
+            'failed': sum(summary['status'] == 'failed' for summary in summaries)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('manifest', help="JSON manifest of the patients")
+    parser.add_argument('--cores-per-job', type=int, default=1, help="cores of each job")
+    parser.add_argument('--memory-gb', type=float, help="memory limit of each job")
+    parser.add_argument('--workers', type=int, help="concurrent jobs, defaults to the cores divided by --cores-per-job")
+    parser.add_argument('--only', nargs='+', help="names of the patients to run")
+    parser.add_argument('--force', action='store_true', help="ignore the checkpoints and rerun every stage")
+    parser.add_argument('--report', help="JSON file for the summary report, printed to stdout by default")
+    args = parser.parse_args(argv)
+    jobs = ReadManifest(args.manifest)
+    if args.only:
+        jobs = [job for job in jobs if job['name'] in args.only]
+    start = time.perf_counter()
+    summaries = RunBatch(jobs, args.cores_per_job, args.memory_gb, args.workers, args.force)
+    report = Report(summaries, time.perf_counter() - start)
+    text = json.dumps(report, indent=1)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0 if report['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+import numpy as np
+from scipy import sparse
+
+
+# storage types of the projection stack, most precise first
+STACK_DTYPES = (np.float32, np.uint16, np.float16)
+# storage types chosen for a memory budget; float16 quantizes intensities in the thousands (a spacing of 4 between
+# 4096 and 8192) and with them the bilinear gradients, it is only used when requested explicitly
+BUDGET_DTYPES = (np.float32, np.uint16)
+
+
+def StackBytes(shape, dtype):
+    '''
+    Returns:
+        int: bytes held by an array of the given shape and dtype
+    '''
+    return int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+
+def ChooseStackDtype(shape, memory_budget=None, integral=True):
+    '''
+    Most precise storage type of the projection stack that fits the memory budget
+    Parameters:
+        shape (tuple): (n_emitters, H, W) shape of the stack
+        memory_budget (int): bytes the stack may use, None keeps float32
+        integral (bool): the intensities are whole numbers (raw or masked projections), uint16 stores them
+                         exactly; fractional intensities (smoothed stacks, cost maps) are only stored as float32
+    Returns:
+        dtype: float32 or uint16
+    '''
+    if memory_budget is None or StackBytes(shape, np.float32) <= memory_budget:
+        return np.dtype(np.float32)
+    if not integral:
+        raise MemoryError("a {} projection stack of fractional intensities needs {} bytes in float32, over the memory "
+                          "budget of {} bytes".format(shape, StackBytes(shape, np.float32), memory_budget))
+    if StackBytes(shape, np.uint16) <= memory_budget:
+        return np.dtype(np.uint16)
+    raise MemoryError("a {} projection stack needs {} bytes in uint16, over the memory budget of {} bytes"
+                      .format(shape, StackBytes(shape, np.uint16), memory_budget))
+
+
+def ResolveStackDtype(shape, dtype=None, memory_budget=None, integral=True):
+    '''
+    Storage type of a projection stack: dtype if given (checked against the memory budget), otherwise
+    ChooseStackDtype
+    Returns:
+        dtype: the storage type
+    '''
+    if dtype is None:
+        return ChooseStackDtype(shape, memory_budget, integral)
+    if memory_budget is not None and StackBytes(shape, dtype) > memory_budget:
+        raise MemoryError("a {} projection stack needs {} bytes in {}, over the memory budget of {} bytes"
+                          .format(shape, StackBytes(shape, dtype), np.dtype(dtype).name, memory_budget))
+    return np.dtype(dtype)
+
+
+def ToStackDtype(image, dtype):
+    '''
+    Convert one projection to the storage type, rounding and clipping to the range of integer types
+    '''
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'u':
+        info = np.iinfo(dtype)
+        return np.clip(np.rint(image), info.min, info.max).astype(dtype)
+    if dtype == np.float16:
+        info = np.finfo(dtype)
+        return np.clip(image, info.min, info.max).astype(dtype)
+    return np.asarray(image, dtype=dtype)
+
+
+def FillStack(images, count, dtype=None, memory_budget=None):
+    '''
+    Store images one at a time into a projection stack of the storage type given by ResolveStackDtype.
+    Whole number intensities (raw and masked projections) are stored exactly as uint16 when float32 does not fit;
+    if a later image is not whole numbers, a MemoryError is raised instead of rounding it (an explicit dtype is
+    always kept)
+    Parameters:
+        images (iterable): HxW images, one per emitter position
+        count (int): number of images stored
+        dtype (dtype): optional storage type
+        memory_budget (int): optional number of bytes the stack may use
+    Returns:
+        array: (count, H, W) stack
+    '''
+    stack = None
+    for i, image in zip(range(count), images):
+        integral = np.all(np.mod(image, 1) == 0)
+        if stack is None:
+            shape = (count,) + np.shape(image)
+            stack = np.empty(shape, dtype=ResolveStackDtype(shape, dtype, memory_budget, integral))
+        elif dtype is None and stack.dtype.kind == 'u' and not integral:
+            # uint16 was chosen because float32 does not fit the budget
+            raise MemoryError("image {} of a {} projection stack is not whole numbers, it needs {} bytes in float32, "
+                              "over the memory budget of {} bytes".format(i, shape, StackBytes(shape, np.float32),
+                                                                         memory_budget))
+        stack[i] = ToStackDtype(image, stack.dtype)
+    return stack
+
+
+class PackedMasks:
+    '''
+    Binary mask stack stored as bits (8 pixels per byte) or as one CSR matrix per mask (only the set pixels),
+    instead of a full uint8 canvas of the detector per emitter position
+    Parameters:
+        masks (array): (e, H, W) mask stack, any nonzero pixel is set
+        kind (string): 'bits' (np.packbits, 1/8 of the uint8 stack) or 'csr' (scipy.sparse, smaller when less
+                       than about 2% of the pixels are set)
+        value (int): pixel value of the set pixels when unpacked
+    Usage:
+        packed = PackedMasks(func.MakeVesselMask(geo_lines, mask, size, MaskDir))
+        for mask in packed:
+            ...
+    '''
+    def __init__(self, masks, kind='bits', value=255):
+        masks = np.asarray(masks)
+        self.shape = masks.shape
+        self.kind = kind
+        self.value = value
+        if kind == 'bits':
+            self.data = np.packbits(masks != 0, axis=-1)
+        elif kind == 'csr':
+            self.data = [sparse.csr_matrix(mask != 0, dtype=bool) for mask in masks]
+        else:
+            raise ValueError("kind must be 'bits' or 'csr', got {}".format(kind))
+
+    @property
+    def nbytes(self):
+        if self.kind == 'bits':
+            return self.data.nbytes
+        return sum(mask.data.nbytes + mask.indices.nbytes + mask.indptr.nbytes for mask in self.data)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, i):
+        '''
+        Returns:
+            array: HxW uint8 mask i
+        '''
+        if self.kind == 'bits':
+            mask = np.unpackbits(self.data[i], axis=-1, count=self.shape[2]).astype(bool)
+        else:
+            mask = self.data[i].toarray()
+        return np.where(mask, np.uint8(self.value), np.uint8(0))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def Unpack(self):
+        '''
+        Returns:
+            array: (e, H, W) uint8 mask stack
+        '''
+        return np.stack(list(self))
@@ -0,0 +1,163 @@
+import numpy as np
+import PythonRigid3DTransform as R
+
+
+def StridedOffsets(offsets, start, step):
+    '''
+    Tube offsets of points[start::step], for the subsampled source points of the notebook
+    Parameters:
+        offsets (array): (t+1) array of offsets of points, from LoadVesselCenterlines
+        start (int): first point kept
+        step (int): stride of the kept points
+    Returns:
+        array: (t+1) array of offsets into points[start::step]
+    '''
+    offsets = np.asarray(offsets, dtype=np.int64)
+    return np.maximum(-(-(offsets - start) // step), 0)
+
+
+class TubeBounds:
+    '''
+    Axis aligned bounding boxes of short runs of consecutive centerline points, computed once so that whole
+    segments can be rejected before projection. A segment never crosses the end of a tube. The frustum test uses
+    the bounding sphere of each box, which stays valid for any rigid pose of the points
+    Parameters:
+        points (array): nx3 array of centerline points (the points that are transformed and projected)
+        offsets (array): (t+1) tube offsets of points (LoadVesselCenterlines, StridedOffsets), None for one tube
+        segment (int): maximum number of points per segment
+        radii (array): optional radius per point, added to the box so the segments cover the painted footprints
+    Usage:
+        bounds = TubeBounds(u, StridedOffsets(offsets, 1, 5))
+        frustums = DetectorFrustums(*func.CTProjectionTransform(y), size, spacing)
+        visible = bounds.PointsVisible(frustums, x)
+    '''
+    def __init__(self, points, offsets=None, segment=32, radii=None):
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if offsets is None:
+            offsets = [0, len(points)]
+        starts = [start for begin, end in zip(offsets[:-1], offsets[1:]) for start in range(begin, end, segment)]
+        # segment s holds points[self.offsets[s]:self.offsets[s+1]]
+        self.offsets = np.array(starts + [len(points)], dtype=np.int64)
+        pad = np.zeros((len(points), 1)) if radii is None else np.asarray(radii, dtype=float).reshape(-1, 1)
+        if len(starts):
+            self.lower = np.minimum.reduceat(points - pad, starts, axis=0)
+            self.upper = np.maximum.reduceat(points + pad, starts, axis=0)
+        else:
+            self.lower = self.upper = np.zeros((0, 3))
+        self.centers = (self.lower + self.upper)/2
+        self.radii = np.linalg.norm(self.upper - self.lower, axis=1)/2
+
+    def __len__(self):
+        return len(self.centers)
+
+    def Visible(self, frustums, x=None):
+        '''
+        Parameters:
+            frustums (array): (e, 5, 4) planes from DetectorFrustums
+            x (array): 1x6 pose the points are transformed with before projection, None for none
+        Returns:
+            array: (e, s) boolean array, False for the segments that project off the detector of an emitter position
+        '''
+        centers = self.centers if x is None else R.TransformPoints(x, self.centers)
+        # signed distance of every sphere center to every plane, (e, 5, s)
+        distance = frustums[:, :, np.newaxis, :3] @ centers.T[np.newaxis, np.newaxis]
+        distance = distance[:, :, 0] + frustums[:, :, 3, np.newaxis]
+        # only spheres completely between the emitter and the detector side of it are culled, the projection
+        # of points behind the emitter flips through it
+        belowEmitter = distance[:, 4] > self.radii
+        outside = (distance[:, :4] < -self.radii).any(axis=1)
+        return ~(belowEmitter & outside)
+
+    def PointsVisible(self, frustums, x=None):
+        '''
+        Returns:
+            array: (e, n) boolean array, False for the points of culled segments
+        '''
+        return np.repeat(self.Visible(frustums, x), np.diff(self.offsets), axis=1)
+
+    def AnyVisible(self, frustums, x=None):
+        '''
+        Returns:
+            array: n boolean array, False for the points that project off the detector at every emitter position
+        '''
+        return np.repeat(self.Visible(frustums, x).any(axis=0), np.diff(self.offsets))
+
+
+def DetectorFrustums(transformClass, EmitterPositions, size, spacing, margin=1):
+    '''
+    Planes of the viewing frustum of every emitter position: the four planes through the emitter and an edge of
+    the detector, and the plane through the emitter parallel to the detector. Normals point into the frustum
+    Parameters:
+        transformClass (class): constructed PythonVersorRigid3DPerspectiveTransform class (detector plane)
+        EmitterPositions (array): ex3 array of emitter positions, from CTProjectionTransform
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+        margin (float): pixels added around the detector, so culled points are outside of the image by at least this
+    Returns:
+        array: (e, 5, 4) array of planes (unit normal, offset), a point p is inside where normal*p + offset >= 0
+    '''
+    p0, p01, p02, normal = transformClass.GetPlaneBasis()
+    scale = spacing*0.194
+    u0, u1 = (-margin - size[0]/2)*scale, (size[0]/2 + margin)*scale
+    v0, v1 = (-margin - size[1]/2)*scale, (size[1]/2 + margin)*scale
+    corners = np.array([p0 + u*p01 + v*p02 for u, v in ((u0, v0), (u1, v0), (u1, v1), (u0, v1))])
+    middle = corners.mean(axis=0)
+    EmitterPositions = np.asarray(EmitterPositions, dtype=float).reshape(-1, 3)
+    frustums = np.empty((len(EmitterPositions), 5, 4))
+    for e, emitter in enumerate(EmitterPositions):
+        toCorners = corners - emitter
+        normals = np.cross(toCorners, np.roll(toCorners, -1, axis=0))
+        normals *= np.sign(normals @ (middle - emitter))[:, np.newaxis]
+        facing = normal*np.sign(normal @ (middle - emitter))
+        normals = np.vstack([normals, facing])
+        normals /= np.linalg.norm(normals, axis=1)[:, np.newaxis]
+        frustums[e, :, :3] = normals
+        frustums[e, :, 3] = -normals @ emitter
+    return frustums
+
+
+class OccupancyGrid:
+    '''
+    Coarse per-emitter grid of the blocks of a projection stack that hold any nonzero pixel. The masked
+    projections are zero away from the vessels, samples in empty blocks are zero without reading the stack
+    Parameters:
+        mask (array): (e, H, W) projection stack
+        block (int): block size in pixels
+    '''
+    def __init__(self, mask, block=16):
+        e, height, width = np.shape(mask)
+        self.block = block
+        self.shape = (height, width)
+        rows, cols = -(-height // block), -(-width // block)
+        self.grid = np.zeros((e, rows, cols), dtype=bool)
+        for i in range(e):
+            nonzero = np.asarray(mask[i]) != 0
+            # a bilinear sample also reads the next row and column, count them as part of the pixel
+            nonzero[:-1] |= nonzero[1:]
+            nonzero[:, :-1] |= nonzero[:, 1:]
+            padded = np.zeros((rows*block, cols*block), dtype=bool)
+            padded[:height, :width] = nonzero
+            self.grid[i] = padded.reshape(rows, block, cols, block).any(axis=(1, 3))
+
+    @property
+    def fraction(self):
+        '''
+        Returns:
+            float: fraction of the blocks that are occupied
+        '''
+        return float(self.grid.mean())
+
+    def Occupied(self, projected):
+        '''
+        Parameters:
+            projected (array): exnx2 array of pixel coordinates (column, row) per emitter position and point
+        Returns:
+            array: exn boolean array, False for points in empty blocks or outside of the image
+        '''
+        emitter = np.arange(len(projected))[:, np.newaxis]
+        col = projected[..., 0]
+        row = projected[..., 1]
+        inside = (col >= 0) & (col < self.shape[1]) & (row >= 0) & (row < self.shape[0])
+        blockCol = np.where(inside, col, 0).astype(np.intp) // self.block
+        blockRow = np.where(inside, row, 0).astype(np.intp) // self.block
+        return inside & self.grid[emitter, blockRow, blockCol]
@@ -1,8 +1,177 @@
 import numpy as np
-import math
+import os
+import hashlib
 import itk
 import PythonVersorRigid3DPerspectiveTransform as T
+import PythonRigid3DTransform as R
 import matplotlib.pyplot as plt
+from imagewriter import ImageWriter
+import telemetry
+import profiling
+import culling
+import compact
+from concurrent.futures import ThreadPoolExecutor
+from scipy import ndimage
+from scipy.optimize import least_squares
+
+
+# coarse-to-fine levels used by PyramidRegistration: projection decimation factor and CT point stride per level
+PYRAMID_LEVELS = [
+    {'factor': 8, 'stride': 20},
+    {'factor': 4, 'stride': 10},
+    {'factor': 1, 'stride': 5},
+]
+
+
+def ReadEmitterGeometry(emitterGeo_file):
+    '''
+    Parse the geo.txt file into the emitter positions
+    Parameters:
+        emitterGeo_file (string): path to file that contains emitter positions, the first line is the fit
+    Returns:
+        array: ex3 float array with the x, y, z position of each emitter
+    '''
+    with open(emitterGeo_file) as f:
+        lines = [line.strip().strip("'").split() for line in f]
+    # first three are "fit" - disregard first line
+    lines = [line for line in lines[1:] if line]
+    return np.array([line[0:3] for line in lines], dtype=float)
+
+
+def AnnotationsToPoints(overlay_list, pixelSpacing=0.194, firstSlice=35, sliceSpacing=3):
+    '''
+    Convert the hand drawn vessel annotation images into 3D tomoRecon points
+    Parameters:
+        overlay_list (list): list of strings of the location of the annotation files, one per reconstruction slice
+        pixelSpacing (float): in-plane spacing of the tomosynthesis reconstruction
+        firstSlice (int): reconstruction slice number of the first annotation file
+        sliceSpacing (float): spacing between reconstruction slices
+    Returns:
+        array: nx3 array of tomoRecon points (x, y, z) of every annotated pixel
+    '''
+    mask = []
+    for vessel_annotation_file, i in zip(overlay_list, range(len(overlay_list))):
+        imgarr = itk.GetArrayFromImage(itk.imread(vessel_annotation_file))
+        index = np.argwhere(imgarr > 0)
+        # column and row index to physical x and y, annotation number to slice depth
+        points = np.empty((len(index), 3))
+        points[:, 0] = index[:, -1]*pixelSpacing
+        points[:, 1] = index[:, -2]*pixelSpacing
+        points[:, 2] = (firstSlice+i)*sliceSpacing
+        mask.append(points)
+    if len(mask) == 0:
+        return np.empty((0, 3))
+    return np.concatenate(mask)
+
+
+def _FileHash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+@telemetry.Timed('load')
+def LoadVesselCenterlines(vessel_file, cache_file=None):
+    '''
+    Extract the tube centerline points and radii from a .tre file, cached in a .npz file so re-running a patient
+    skips the SpatialObject traversal. The cache is reused while the .tre modification time is unchanged, or
+    when its content hash still matches
+    Parameters:
+        vessel_file (string): path to .tre file that contains tubes spatial objects of segmented pulmonary vasculature
+        cache_file (string): path of the .npz cache (used as given, with or without the suffix),
+                             defaults to <vessel_file without extension>_centerlines.npz
+    Returns:
+        array: nx3 array of centerline positions in object space (x, y, z, as stored in the .tre file)
+        array: nx1 array of the radius of each point
+        array: (t+1) array of offsets, the points of tube k are points[offsets[k]:offsets[k+1]]
+    '''
+    if cache_file is None:
+        cache_file = os.path.splitext(vessel_file)[0]+"_centerlines.npz"
+    mtime = os.path.getmtime(vessel_file)
+    if os.path.isfile(cache_file):
+        with np.load(cache_file) as cache:
+            cached = {key: cache[key] for key in cache.files}
+        if float(cached['mtime']) == mtime:
+            return cached['points'], cached['radii'], cached['offsets']
+        if str(cached['sha1']) == _FileHash(vessel_file):
+            # touched but unchanged, remember the new modification time
+            cached['mtime'] = mtime
+            _SaveCenterlines(cache_file, cached)
+            return cached['points'], cached['radii'], cached['offsets']
+    points = []
+    radii = []
+    offsets = [0]
+    for tube_points, tube_radii in _IterTubes(vessel_file):
+        points.append(tube_points)
+        radii.append(tube_radii)
+        offsets.append(offsets[-1] + len(tube_points))
+    points = np.concatenate(points) if len(points) else np.empty((0, 3))
+    radii = np.concatenate(radii) if len(radii) else np.empty(0)
+    offsets = np.array(offsets, dtype=np.int64)
+    _SaveCenterlines(cache_file, dict(points=points, radii=radii, offsets=offsets, mtime=mtime,
+                                      sha1=_FileHash(vessel_file)))
+    return points, radii, offsets
+
+
+def _SaveCenterlines(cache_file, arrays):
+    # written through a file handle, np.savez would append .npz to a path without it and the cache would never hit
+    with open(cache_file, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def _IterTubes(vessel_file):
+    # centerline points (mx3) and radii (m) of one tube of the .tre file at a time
+    Dimension = 3
+    reader = itk.SpatialObjectReader[Dimension].New()
+    reader.SetFileName(vessel_file)
+    reader.Update()
+    tubes = reader.GetGroup()
+    castSO = itk.CastSpatialObjectFilter[3].New()
+    castSO.SetInput(tubes)
+    tubesSO = castSO.GetTubes()
+    for i in range(tubes.GetNumberOfChildren()):
+        tube_points = tubesSO[i].GetPoints()
+        yield (np.array([list(point.GetPositionInObjectSpace()) for point in tube_points], dtype=float).reshape(-1, 3),
+               np.array([point.GetRadiusInObjectSpace() for point in tube_points], dtype=float))
+
+
+def IterVesselCenterlines(vessel_file, chunk=65536):
+    '''
+    Stream the tube centerline points and radii of a .tre file in blocks of a fixed number of points, so that
+    whole-lung trees never have to be held as one list (same point order and object space as LoadVesselCenterlines)
+    Parameters:
+        vessel_file (string): path to .tre file that contains tubes spatial objects of segmented pulmonary vasculature
+        chunk (int): number of points per block (the last block may be shorter)
+    Returns:
+        generator: (points, radii) blocks, chunkx3 and chunkx1 arrays
+    '''
+    pending, pendingRadii, count = [], [], 0
+    for points, radii in _IterTubes(vessel_file):
+        pending.append(points)
+        pendingRadii.append(radii)
+        count += len(points)
+        while count >= chunk:
+            points, radii = np.concatenate(pending), np.concatenate(pendingRadii)
+            yield points[:chunk], radii[:chunk]
+            pending, pendingRadii, count = [points[chunk:]], [radii[chunk:]], count - chunk
+    if count:
+        yield np.concatenate(pending), np.concatenate(pendingRadii)
+
+
+def ChunkPoints(points, chunk, radii=None):
+    '''
+    Split a point array (and its radii) into blocks of a fixed number of points
+    Parameters:
+        points (array): nx3 array of points
+        chunk (int): number of points per block (the last block may be shorter)
+        radii (array): optional nx1 array of the radius of each point
+    Returns:
+        generator: (points, radii) blocks, radii is None without radii
+    '''
+    for start in range(0, len(points), chunk):
+        yield points[start:start+chunk], None if radii is None else radii[start:start+chunk]
 
 
 def GetProjectedPointsTRTP(points, transformClass, size):
@@ -18,20 +187,8 @@ def GetProjectedPointsTRTP(points, transformClass, size):
         array: nx3 array of the point of intersections in 3D space between the emitter and the detection plane
         array: nx1 array of the t value in the parametric equation defines in the link
     '''
-    projectedPoints = []
-    point_of_intersection = []
-    t_vals = []
-    for point in points:
-        projected, num, t = transformClass.TransformPoint(point)
-        projectedPoint = [((projected[0]+(size[0]/2))/0.194),
-                         ((projected[1]+(size[1]/2))/0.194)
-                         ]
-        point_of_intersection = np.append(point_of_intersection, num)
-        t_vals = np.append(t_vals, t)
-        projectedPoints.append(projectedPoint)
-    projectedPoints = np.array(projectedPoints)
-    projectedPoints = projectedPoints.reshape((len(points), 2))
-    point_of_intersection = point_of_intersection.reshape((len(points), 3))
+    projected, point_of_intersection, t_vals = transformClass.TransformPoints(points)
+    projectedPoints = (projected + np.array([size[0]/2, size[1]/2]))/0.194
     return projectedPoints, point_of_intersection, t_vals
 
 
@@ -44,12 +201,9 @@ def TransformAllPoints3D(translationMatrix, points):
     Returns:
         array: nx3 array of transformed 3D points
     '''
-    new_source_points = []
-    for point in points:
-        point = np.append(point, 1)
-        new_point = np.dot(translationMatrix, point.T)
-        new_source_points = np.append(new_source_points, new_point[0:3])
-    new_source_points = new_source_points.reshape((len(points), 3))
+    translationMatrix = np.asarray(translationMatrix)
+    new_source_points = np.asarray(points, dtype=float).reshape(-1, 3) @ translationMatrix[0:3, 0:3].T
+    new_source_points += translationMatrix[0:3, 3]
     return new_source_points
  
     
@@ -64,36 +218,8 @@ def TransformAllPointsAllParameters(x, points):
     Returns:
         array: nx3 array of transformed 3D points 
     '''
-    # rotation matrix in z direction
-    rotationMatrixZ = np.array([[math.cos(x[3]), -math.sin(x[3]), 0, 0],
-                                [math.sin(x[3]), math.cos(x[3]), 0, 0],
-                                [0, 0, 1, 0],
-                                [0, 0, 0, 1]
-    ])
-    # rotation matrix in y direction
-    rotationMatrixY = np.array([[math.cos(x[4]), 0, math.sin(x[4]), 0],
-                                [0, 1, 0, 0],
-                                [-math.sin(x[4]), 0, math.cos(x[4]), 0],
-                                [0, 0, 0, 1]
-    ])
-    # rotation matrix in x direction
-    rotationMatrixX = np.array([[1, 0, 0, 0],
-                                [0, math.cos(x[5]), -math.sin(x[5]), 0],
-                                [0, math.sin(x[5]), math.cos(x[5]), 0],
-                                [0, 0, 0, 1]
-    ])
-    # translation matrix in x, y, z direction
-    translationMatrixD = np.array([[1, 0, 0, x[0]],
-                                   [0, 1, 0, x[1]],
-                                   [0, 0, 1, x[2]],
-                                   [0, 0, 0, 1]
-    ])
-    # use transformPoints3D to transform each point, returns array of all transformed points
-    points = TransformAllPoints3D(rotationMatrixZ, points)
-    points = TransformAllPoints3D(rotationMatrixY, points)
-    points = TransformAllPoints3D(rotationMatrixX, points)
-    points = TransformAllPoints3D(translationMatrixD, points)
-    return points
+    # rotation in z, y, x then translation, composed into one matrix and applied in one pass
+    return R.TransformPoints(x, points)
 
 
 def TransformOnePointAllParameters(x, points):
@@ -107,36 +233,8 @@ def TransformOnePointAllParameters(x, points):
     Returns:
         array: nx3 array of transformed 3D points 
     '''
-    # rotation matrix in z direction
-    rotationMatrixZ = np.array([[math.cos(x[3]), -math.sin(x[3]), 0, 0],
-                                [math.sin(x[3]), math.cos(x[3]), 0, 0],
-                                [0, 0, 1, 0],
-                                [0, 0, 0, 1]
-    ])
-    # rotation matrix in y direction
-    rotationMatrixY = np.array([[math.cos(x[4]), 0, math.sin(x[4]), 0],
-                                [0, 1, 0, 0],
-                                [-math.sin(x[4]), 0, math.cos(x[4]), 0],
-                                [0, 0, 0, 1]
-    ])
-    # rotation matrix in x direction
-    rotationMatrixX = np.array([[1, 0, 0, 0],
-                                [0, math.cos(x[5]), -math.sin(x[5]), 0],
-                                [0, math.sin(x[5]), math.cos(x[5]), 0],
-                                [0, 0, 0, 1]
-    ])
-    # translation matrix in x, y, z direction
-    translationMatrixD = np.array([[1, 0, 0, x[0]],
-                                   [0, 1, 0, x[1]],
-                                   [0, 0, 1, x[2]],
-                                   [0, 0, 0, 1]
-    ])
-    # use transformPoints3D to transform each point, returns array of all transformed points
-    points = TransformOnePoint3D(rotationMatrixZ, points)
-    points = TransformOnePoint3D(rotationMatrixY, points)
-    points = TransformOnePoint3D(rotationMatrixX, points)
-    points = TransformOnePoint3D(translationMatrixD, points)
-    return points
+    # rotation in z, y, x then translation, composed into one matrix
+    return TransformOnePoint3D(R.RigidMatrix(x), points)
 
 
 def model(x, u, transformClass, imageSize):
@@ -152,35 +250,8 @@ def model(x, u, transformClass, imageSize):
     Returns:
         array: 1x2 array that defines the projected 2D point
     '''
-    # rotation matrix in z direction
-    rotationMatrixZ = np.array([[math.cos(x[3]), -math.sin(x[3]), 0, 0],
-                                [math.sin(x[3]), math.cos(x[3]), 0, 0],
-                                [0, 0, 1, 0],
-                                [0, 0, 0, 1]
-    ])
-    # rotation matrix in y direction
-    rotationMatrixY = np.array([[math.cos(x[4]), 0, math.sin(x[4]), 0],
-                                [0, 1, 0, 0],
-                                [-math.sin(x[4]), 0, math.cos(x[4]), 0],
-                                [0, 0, 0, 1]
-    ])
-    # rotation matrix in x direction
-    rotationMatrixX = np.array([[1, 0, 0, 0],
-                                [0, math.cos(x[5]), -math.sin(x[5]), 0],
-                                [0, math.sin(x[5]), math.cos(x[5]), 0],
-                                [0, 0, 0, 1]
-    ])
-    # translation matrix in x, y, z direction
-    translationMatrixD = np.array([[1, 0, 0, x[0]],
-                                   [0, 1, 0, x[1]],
-                                   [0, 0, 1, x[2]],
-                                   [0, 0, 0, 1]
-    ])
-    # use transformPoints3D function to transform each point in a pointset using a tranformation matrix
-    point = TransformOnePoint3D(rotationMatrixZ, u)
-    point = TransformOnePoint3D(rotationMatrixY, point)
-    point = TransformOnePoint3D(rotationMatrixX, point)
-    point = TransformOnePoint3D(translationMatrixD, point)
+    # rotation in z, y, x then translation, composed into one matrix
+    point = TransformOnePoint3D(R.RigidMatrix(x), u)
     projected, _, _ = transformClass.TransformPoint(point)
     point = [((projected[0]+(imageSize[0]/2))/0.194),
              ((projected[1]+(imageSize[1]/2))/0.194)
@@ -197,9 +268,8 @@ def TransformOnePoint3D(translationMatrix, point):
     Returns
         array: 1x3 array of 3D transformed point
     '''
-    point = np.append(point, 1)
-    new_point = np.dot(translationMatrix, point.T)
-    new_source_point = new_point[0:3]
+    translationMatrix = np.asarray(translationMatrix)
+    new_source_point = translationMatrix[0:3, 0:3] @ np.asarray(point, dtype=float) + translationMatrix[0:3, 3]
     return new_source_point
 
 
@@ -216,35 +286,8 @@ def modelCT(x, u, transformClass, size, spacing):
     Returns:
         array: 1x2 array that defines the projected 2D point
     '''
-    # rotation matrix in z direction
-    rotationMatrixZ = np.array([[math.cos(x[3]), -math.sin(x[3]), 0, 0],
-                                [math.sin(x[3]), math.cos(x[3]), 0, 0],
-                                [0, 0, 1, 0],
-                                [0, 0, 0, 1]
-    ])
-    # rotation matrix in y direction
-    rotationMatrixY = np.array([[math.cos(x[4]), 0, math.sin(x[4]), 0],
-                                [0, 1, 0, 0],
-                                [-math.sin(x[4]), 0, math.cos(x[4]), 0],
-                                [0, 0, 0, 1]
-    ])
-    # rotation matrix in x direction
-    rotationMatrixX = np.array([[1, 0, 0, 0],
-                                [0, math.cos(x[5]), -math.sin(x[5]), 0],
-                                [0, math.sin(x[5]), math.cos(x[5]), 0],
-                                [0, 0, 0, 1]
-    ])
-    # translation matrix in x, y, z direction
-    translationMatrixD = np.array([[1, 0, 0, x[0]],
-                                   [0, 1, 0, x[1]],
-                                   [0, 0, 1, x[2]],
-                                   [0, 0, 0, 1]
-    ])
-    # use transformPoints3D function to transform each point in a pointset using a tranformation matrix
-    point = TransformOnePoint3D(rotationMatrixZ, u)
-    point = TransformOnePoint3D(rotationMatrixY, point)
-    point = TransformOnePoint3D(rotationMatrixX, point)
-    point = TransformOnePoint3D(translationMatrixD, point)
+    # rotation in z, y, x then translation, composed into one matrix
+    point = TransformOnePoint3D(R.RigidMatrix(x), u)
     # project transformed points
     projected, _, _ = transformClass.TransformPoint(point)
     projected_point =  [projected[0]/(spacing*0.194)+size[0]/2, projected[1]/(spacing*0.194)+size[1]/2]
@@ -252,7 +295,7 @@ def modelCT(x, u, transformClass, size, spacing):
     return projected_point
 
 
-def GetProjectedPointsCTTP(points, transformClass, size, spacing):
+def GetProjectedPointsCTTP(points, transformClass, size, spacing, tube_bounds=None):
     '''
     Project 3D CT points to 2D points using PythonVersorRigid3DPerspectiveTransform
     https://en.wikipedia.org/wiki/Line%E2%80%93plane_intersection 
@@ -261,85 +304,251 @@ def GetProjectedPointsCTTP(points, transformClass, size, spacing):
         transformClass (class): constructed PythonVersorRigid3DPerspectiveTransform class
         size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
         spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+        tube_bounds (class): optional culling.TubeBounds of points, the points of segments that project off the detector
+                             are not projected and returned as NaN
     Returns:
         array: nx2 array of projected points where n is the number of points
         array: nx3 array of the point of intersections in 3D space between the emitter and the detection plane
         array: nx1 array of the t value in the parametric equation defines in the link
     '''
-    projectedPoints = []
-    point_of_intersection = []
-    t_vals = []
-    for point in points:
-        # tranform each point and store output values
-        projected, num, t = transformClass.TransformPoint(point)
-        projectedPoints = np.append(projectedPoints, 
-                                    [projected[0]/(spacing*0.194)+size[0]/2, 
-                                     projected[1]/(spacing*0.194)+size[1]/2])
-        point_of_intersection = np.append(point_of_intersection, num)
-        t_vals = np.append(t_vals, t)
-    # reshape (np.append flattens array)
-    projectedPoints = projectedPoints.reshape((len(points), 2))
-    point_of_intersection = point_of_intersection.reshape((len(points), 3))
-    # return list of each output value of each point
+    if tube_bounds is not None:
+        frustums = culling.DetectorFrustums(transformClass, transformClass.EmitterPosition, size, spacing)
+        keep = tube_bounds.AnyVisible(frustums)
+        projectedPoints = np.full((len(keep), 2), np.nan)
+        point_of_intersection = np.full((len(keep), 2), np.nan)
+        t_vals = np.full(len(keep), np.nan)
+        projectedPoints[keep], point_of_intersection[keep], t_vals[keep] = GetProjectedPointsCTTP(
+            np.asarray(points)[keep], transformClass, size, spacing)
+        return projectedPoints, point_of_intersection, t_vals
+    # tranform all points at once
+    projected, point_of_intersection, t_vals = transformClass.TransformPoints(points)
+    projectedPoints = projected/(spacing*0.194) + np.array([size[0]/2, size[1]/2])
     return projectedPoints, point_of_intersection[:,:2], t_vals
 
 
-def MakeVesselMask(y, source, size, destDir):
+def WriteImages(arrays, paths, writer=None):
     '''
-    Function to make x number of toy vessel images with different geometries
-    using transformed tomosynthesis reconstruction source points, where x is the number of emitter positions
+    Write one image per path through an ImageWriter (atomic writes on a bounded worker pool)
+    Parameters:
+        arrays (array): list or stack of image arrays
+        paths (list): list of strings of the destination files
+        writer (class): optional ImageWriter to queue the writes on. Without one, a process pool ImageWriter
+                        is created and every image is written before returning
+    Returns:
+        None
+    '''
+    if writer is not None:
+        writer.WriteAll(arrays, paths)
+        return
+    with ImageWriter() as writer:
+        for array, path, i in zip(arrays, paths, range(len(paths))):
+            writer.Write(array, path)
+            telemetry.Progress('write', i, len(paths))
+
+
+def RasterizePoints(projected, size, halfSize, value=255, out=None):
+    '''
+    Paint a rectangle around every projected point of every emitter position into one uint8 image stack.
+    Sparse uniform footprints are scattered directly, dense or per-point footprints are accumulated with a
+    2D difference array so the cost does not depend on the number of points or the footprint size
     Parameters:
+        projected (array): exnx2 array of pixel coordinates (column, row) per emitter position and point
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        halfSize (array): (rows, columns) half height and half width of the footprint in pixels, each either
+                          a scalar or an exn / n array of per-point values (e.g. from the tube radii)
+        value (int): pixel value inside the footprints
+        out (array): optional exHxW uint8 image stack to paint into (blocks of points accumulate in one stack)
+    Returns:
+        array: exHxW uint8 array of the painted images
+    '''
+    width, height = int(size[0]), int(size[1])
+    if np.shape(projected)[-2] == 0:
+        # no points, nothing is painted (the emitter count cannot be inferred from an empty reshape)
+        if out is not None:
+            return out
+        return np.zeros(np.shape(projected)[:-2] + (height, width), dtype=np.uint8).reshape(-1, height, width)
+    projected = np.asarray(projected, dtype=float).reshape(-1, np.shape(projected)[-2], 2)
+    uniform = np.ndim(halfSize[0]) == 0 and np.ndim(halfSize[1]) == 0
+    halfRows = np.broadcast_to(np.asarray(halfSize[0]), projected.shape[:2]).astype(np.intp)
+    halfCols = np.broadcast_to(np.asarray(halfSize[1]), projected.shape[:2]).astype(np.intp)
+    images = np.zeros((len(projected), height, width), dtype=np.uint8) if out is None else out
+    for e in range(len(projected)):
+        col = projected[e, :, 0]
+        row = projected[e, :, 1]
+        inside = (col >= 0) & (col < width) & (row >= 0) & (row < height)
+        col = col[inside].astype(np.intp)
+        row = row[inside].astype(np.intp)
+        if len(row) == 0:
+            continue
+        if uniform:
+            rowOffsets = np.arange(-int(halfSize[0]), int(halfSize[0]))
+            colOffsets = np.arange(-int(halfSize[1]), int(halfSize[1]))
+            if len(row)*len(rowOffsets)*len(colOffsets) < height*width // 4:
+                # points that fall in the same pixel paint the same footprint
+                centers = np.unique(row*width + col)
+                row, col = centers // width, centers % width
+                # footprint [row-h, row+h) x [col-w, col+w), clipped to the image
+                rows, cols = np.broadcast_arrays(row[:, np.newaxis, np.newaxis] + rowOffsets[:, np.newaxis],
+                                                 col[:, np.newaxis, np.newaxis] + colOffsets)
+                keep = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+                images[e][rows[keep], cols[keep]] = value
+                continue
+            halfRowsE = np.full(len(row), int(halfSize[0]))
+            halfColsE = np.full(len(row), int(halfSize[1]))
+        else:
+            halfRowsE = halfRows[e][inside]
+            halfColsE = halfCols[e][inside]
+        row0 = np.clip(row - halfRowsE, 0, height)
+        row1 = np.clip(row + halfRowsE, 0, height)
+        col0 = np.clip(col - halfColsE, 0, width)
+        col1 = np.clip(col + halfColsE, 0, width)
+        # only the bounding box of the footprints is accumulated
+        top, left = row0.min(), col0.min()
+        boxHeight, boxWidth = row1.max() - top, col1.max() - left
+        row0, row1, col0, col1 = row0 - top, row1 - top, col0 - left, col1 - left
+        # +1 at the top left and bottom right corners, -1 at the other two, then a 2D cumulative sum
+        corners = np.concatenate([row0*(boxWidth+1) + col0, row1*(boxWidth+1) + col1,
+                                  row0*(boxWidth+1) + col1, row1*(boxWidth+1) + col0])
+        weights = np.repeat(np.array([1, 1, -1, -1], dtype=np.int32), len(row0))
+        coverage = np.zeros((boxHeight+1)*(boxWidth+1), dtype=np.int32)
+        np.add.at(coverage, corners, weights)
+        coverage = coverage.reshape(boxHeight+1, boxWidth+1)
+        np.cumsum(coverage, axis=0, dtype=np.int32, out=coverage)
+        np.cumsum(coverage, axis=1, dtype=np.int32, out=coverage)
+        images[e, top:top+boxHeight, left:left+boxWidth][coverage[:boxHeight, :boxWidth] > 0] = value
+    return images
+
+
+def ProjectTRPoints(source, y, size):
+    '''
+    Project 3D tomoRecon points onto the tomosynthesis projection for every emitter position
+    Parameters:
+        source (array): nx3 array of 3D tomoRecon source points
         y (array): parsed geo.txt file that contains emitter positions
-        source (array): 3D tomoRecon source points
         size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
-        destDir (string): string that descibes directory of where the mask .dcm files should be written 
     Returns:
-        None
+        array: exnx2 array of projected pixel coordinates (column, row) per emitter position and point
     '''
     CenterOfRotation = np.array([0, 0, 0])                     # not used in the transform point (using center of field)
     PlaneCenter = np.array([size[0]/2, size[1]/2, 0])          # center of detector
     PlaneNormal = np.array([0, 0, 1])                          # vector normal
     xDirection = np.array([size[0]/2+1, size[1]/2, 0])         # vector x direction
     yDirection = np.array([size[0]/2, size[1]/2+1, 0])         # vector y direction
-    count = 1
-    for line, i in zip(y, range(len(y))):
-        new_points = []
-        EmitterPosition = [(size[0]/2)*0.194-line[0], (size[1]/2)*0.194+line[1], line[2]]
-        # update projection class
-        ProjP = T.VersorRigid3DPerspectiveTransform(CenterOfRotation, EmitterPosition,
-                                                    PlaneCenter, PlaneNormal, 
-                                                    xDirection, yDirection) 
-        # project point
-        # make blank array with Tomo Projection size
-        array = np.zeros(shape=[size[1], size[0]], dtype=np.uint8)
-        # for each projected point, draw 10x12 point in image
-        for point3D in source:
-            projected,_ ,_ = ProjP.TransformPoint(np.array([point3D[0], point3D[1], point3D[2]]))
-            point = [((projected[0]+(size[0]/2))/0.194),
-                     ((projected[1]+(size[1]/2))/0.194)
-                    ]
-            new_points.append(point)
-        for point in new_points:
-            if point[0]>=1536:
-                None
-            elif point[0]<0:
-                None
-            elif point[1]>=2048:
-                None
-            elif point[1]<0:
-                None
-            else:
-                ind_1lb = int(point[1])-10
-                ind_1ub = int(point[1])+10
-                ind_2lb = int(point[0])-12
-                ind_2ub = int(point[0])+12
-                array[ind_1lb:ind_1ub, ind_2lb:ind_2ub] = 255
-
-        print("line {} of 29 complete".format(count))
-        count = count + 1
-        img = itk.GetImageFromArray(array)
-        new_suffix = f'{i+1:02}.dcm'
-        itk.imwrite(img, destDir+"/mask_"+new_suffix)
+    EmitterPositions = np.array([[(size[0]/2)*0.194-line[0], (size[1]/2)*0.194+line[1], line[2]] for line in y])
+    ProjP = T.VersorRigid3DPerspectiveTransform(CenterOfRotation, EmitterPositions[0],
+                                                PlaneCenter, PlaneNormal, 
+                                                xDirection, yDirection) 
+    # project every point for every emitter position
+    projected, _, _ = ProjP.TransformPointsMultiEmitter(source, EmitterPositions)
+    return (projected + np.array([size[0]/2, size[1]/2]))/0.194
+
+
+def MakeVesselMask(y, source, size, destDir, writer=None, packed=None, chunk=None):
+    '''
+    Function to make x number of toy vessel images with different geometries
+    using transformed tomosynthesis reconstruction source points, where x is the number of emitter positions
+    Parameters:
+        y (array): parsed geo.txt file that contains emitter positions
+        source (array): 3D tomoRecon source points
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        destDir (string): string that descibes directory of where the mask .dcm files should be written 
+        writer (class): optional ImageWriter to queue the writes on, by default a process pool is used for this call
+        packed (string): optional compact.PackedMasks kind ('bits' or 'csr') to return the masks packed
+        chunk (int): optional number of points projected at once, bounds the memory of the projected points
+    Returns:
+        array: exHxW uint8 array of the written masks, one per emitter position (compact.PackedMasks if packed)
+    '''
+    source = np.asarray(source, dtype=float).reshape(-1, 3)
+    masks = np.zeros((len(y), int(size[1]), int(size[0])), dtype=np.uint8)
+    for block, _ in ChunkPoints(source, chunk or max(len(source), 1)):
+        # for each projected point, draw 20x24 rectangle in image
+        RasterizePoints(ProjectTRPoints(block, y, size), size, (10, 12), out=masks)
+    paths = [destDir+"/mask_"+f'{i+1:02}.dcm' for i in range(len(masks))]
+    WriteImages(masks, paths, writer)
+    if packed is not None:
+        if writer is not None:
+            # the queued writes still read the full masks
+            writer.Wait()
+        return compact.PackedMasks(masks, packed)
+    return masks
+
+
+def TransformTubePoints(positions, x_init, solution, size, spacing):
+    '''
+    Map tube positions from CT object space to tomosynthesis reconstruction space: swap to the registration
+    axis order, apply the initial transform followed by the registration solution as one composed matrix,
+    then scale into the reconstruction volume
+    Parameters:
+        positions (array): nx3 array of tube positions in object space (as stored in the .tre file)
+        x_init (array): 1x6 initial transform used to situate the vessels before registration
+        solution (array): 1x6 registration solution
+        size (array): 1x3 array of pixel dimensions of the tomosynthesis reconstruction volume
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+    Returns:
+        array: nx3 array of positions in reconstruction space
+    '''
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)[:, [0, 2, 1]]
+    # solution applied after x_init
+    matrix = R.RigidMatrix(solution) @ R.RigidMatrix(x_init)
+    new_points = TransformAllPoints3D(matrix, positions)
+    new_points[:, 0] = (new_points[:, 0]/spacing)+(size[0]/2)*0.194
+    new_points[:, 1] = (new_points[:, 1]/spacing)+(size[1]/2)*0.194
+    new_points[:, 2] = (((new_points[:, 2]/0.6))*0.7079646+(size[2]/2)*3)*-1
+    return new_points
+
+
+def GetTubePoints(tubes):
+    '''
+    Gather the positions of every point of every tube in a group into one array
+    Parameters:
+        tubes (SpatialObject): group of tubes read with itk.SpatialObjectReader (reader.GetGroup())
+    Returns:
+        list: the down cast tube spatial objects
+        array: nx3 array of positions in object space
+        array: (t+1) array of offsets, the points of tube k are positions[offsets[k]:offsets[k+1]]
+    '''
+    sobj = tubes.GetChildren(0)
+    tube_list = [itk.down_cast(sobj[tube_num]) for tube_num in range(len(sobj))]
+    positions = []
+    offsets = [0]
+    for tube in tube_list:
+        positions.extend([list(point.GetPositionInObjectSpace()) for point in tube.GetPoints()])
+        offsets.append(len(positions))
+    return tube_list, np.array(positions, dtype=float).reshape(-1, 3), np.array(offsets, dtype=np.int64)
+
+
+def SetTubePoints(tube_list, positions, offsets):
+    '''
+    Write positions back into the tubes, one tube at a time
+    Parameters:
+        tube_list (list): tube spatial objects from GetTubePoints
+        positions (array): nx3 array of new positions in the same order as GetTubePoints
+        offsets (array): (t+1) array of offsets from GetTubePoints
+    Returns:
+        None
+    '''
+    for tube, start, stop in zip(tube_list, offsets[:-1], offsets[1:]):
+        tube_points = tube.GetPoints()
+        for point, new_point in zip(tube_points, positions[start:stop].tolist()):
+            point.SetPositionInObjectSpace(new_point)
+
+
+def TransformTubes(tubes, x_init, solution, size, spacing):
+    '''
+    Transform every tube point in a group with the initial transform and the registration solution
+    and map it into tomosynthesis reconstruction space, in place
+    Parameters:
+        tubes (SpatialObject): group of tubes read with itk.SpatialObjectReader (reader.GetGroup())
+        x_init (array): 1x6 initial transform used to situate the vessels before registration
+        solution (array): 1x6 registration solution
+        size (array): 1x3 array of pixel dimensions of the tomosynthesis reconstruction volume
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+    Returns:
+        int: number of transformed points
+    '''
+    tube_list, positions, offsets = GetTubePoints(tubes)
+    SetTubePoints(tube_list, TransformTubePoints(positions, x_init, solution, size, spacing), offsets)
+    return len(positions)
 
 
 def ProjectPositionCT(x, line, pnts, imgPath, size):
@@ -415,117 +624,880 @@ def ProjectPositionTR(x, line, pnts, imgPath, size):
     plt.show()
 
 
-def MakeVesselOverlay(y, source, size, destDir, spacing):
+def MakeVesselOverlay(y, source, size, destDir, spacing, radii=None, writer=None, tube_bounds=None, chunk=None):
     '''
     Function to write x number of vessel overlay images with different geometries
     using source vessel points
     Parameters:
         y (array): nx3 array that contains an emitter position per line (most likely one line of the geo.txt file)
-        source (array): 3D CT source points
+        source (array): 3D CT source points, or an iterator of (points, radii) blocks (e.g. IterVesselCenterlines
+                        transformed block by block), which are projected and painted one block at a time
         size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
         destDir (string): path to directory where user wants the overlay to be written
         spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+        radii (array): optional tube radius per source point, scales each footprint to the magnified vessel
+                       radius instead of the fixed 6x6 pixel square
+        writer (class): optional ImageWriter to queue the writes on, by default a process pool is used for this call
+        tube_bounds (class): optional culling.TubeBounds of source, segments that project off the detector at every
+                             emitter position are not projected (source array only)
+        chunk (int): optional number of points projected at once, bounds the memory of the projected points
+                     to e*chunk instead of e*n (an iterator of blocks is always streamed)
     Returns:
-        None
+        array: exHxW uint8 array of the written overlays, one per emitter position
+    '''
+    if isinstance(source, (np.ndarray, list, tuple)):
+        source = np.asarray(source, dtype=float).reshape(-1, 3)
+        if tube_bounds is not None:
+            # the footprint of a point is only painted when its center is on the detector
+            keep = tube_bounds.AnyVisible(culling.DetectorFrustums(*CTProjectionTransform(y), size, spacing))
+            source = source[keep]
+            radii = None if radii is None else np.asarray(radii)[keep]
+        source = ChunkPoints(source, chunk or max(len(source), 1), radii)
+    overlays = np.zeros((len(y), int(size[1]), int(size[0])), dtype=np.uint8)
+    for new_points, t, blockRadii in ProjectCTPointChunks(source, y, size, spacing):
+        halfSize = 3
+        if blockRadii is not None:
+            # 1 - t is the magnification from the point to the detector plane
+            halfSize = np.maximum(np.ceil(np.asarray(blockRadii)*(1-t)/(spacing*0.194)), 1)
+        RasterizePoints(new_points, size, (halfSize, halfSize), out=overlays)
+    paths = [destDir+"/vessOverlay_"+f'{i+1:02}.dcm' for i in range(len(overlays))]
+    WriteImages(overlays, paths, writer)
+    return overlays
+
+
+def MaskedProjections(projections, y, source, size, debugDir=None, writer=None):
+    '''
+    Fused preprocessing (notebook steps 3 to 5): flip each raw tomosynthesis projection, paint its vessel mask
+    from the projected tomoRecon annotation points and apply the mask, one emitter position at a time in memory
+    Parameters:
+        projections (list): list of strings of the location of the raw tomosynthesis projections (Image_XX.dcm)
+                            or the raw projection arrays, one per emitter position
+        y (array): parsed geo.txt file that contains emitter positions
+        source (array): nx3 array of 3D tomoRecon annotation points
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        debugDir (string): if set, the intermediate FlippedImage_XX.mha, mask_XX.dcm and maskedTomo_XX.mha
+                           files are written to this directory
+        writer (class): optional ImageWriter for the debug files
+    Yields:
+        array: HxW float32 masked projection, in emitter position order
+    '''
+    new_points = ProjectTRPoints(source, y, size)
+    own = debugDir is not None and writer is None
+    if own:
+        writer = ImageWriter()
+    try:
+        for i in range(min(len(projections), len(new_points))):
+            img = projections[i]
+            if not isinstance(img, np.ndarray):
+                img = itk.GetArrayFromImage(itk.imread(img))
+            img = np.fliplr(np.squeeze(img)).astype(np.float32)
+            # for each projected point, draw 20x24 rectangle in the mask
+            mask = RasterizePoints(new_points[i:i+1], size, (10, 12))[0]
+            # same as itk.MaskImageFilter: keep the input where the mask is set, 0 elsewhere
+            masked = np.where(mask != 0, img, np.float32(0))
+            if debugDir is not None:
+                new_suffix = f'{i+1:02}'
+                writer.Write(img, debugDir+"/FlippedImage_"+new_suffix+".mha")
+                writer.Write(mask, debugDir+"/mask_"+new_suffix+".dcm")
+                writer.Write(masked, debugDir+"/maskedTomo_"+new_suffix+".mha")
+            yield masked
+    finally:
+        if own:
+            writer.close()
+
+
+def MaskedProjectionStack(projections, y, source, size, debugDir=None, writer=None, dtype=None, memory_budget=None):
+    '''
+    Collect MaskedProjections into a read-only projection stack for the registration objective,
+    holding only one emitter position's intermediate images at a time
+    Parameters:
+        same as MaskedProjections
+        dtype (dtype): storage type of the stack, see LoadProjectionStack
+        memory_budget (int): optional number of bytes the stack may use, see LoadProjectionStack
+    Returns:
+        array: read-only (n_emitters, H, W) array of masked projections (float32 unless compacted)
+    '''
+    n = min(len(projections), len(y))
+    stack = compact.FillStack(MaskedProjections(projections, y, source, size, debugDir, writer), n, dtype,
+                              memory_budget)
+    stack.flags.writeable = False
+    return stack
+
+
+@telemetry.Timed('load')
+def LoadProjectionStack(paths, cache_file=None, dtype=None, memory_budget=None):
+    '''
+    Read the masked tomosynthesis projections once into a contiguous, read-only stack so the
+    registration objective never has to decode images from disk
+    Parameters:
+        paths (list): list of strings of the location of the masked projection images, one per emitter position,
+                      or the in-memory image arrays (e.g. returned by an ImageWriter) to skip reading them back
+        cache_file (string): optional path to a .npy file. If the file exists and is newer than every image in paths,
+                             it is memory-mapped instead of re-reading the images, otherwise it is (re)written
+        dtype (dtype): storage type of the stack, float32, uint16 (rounded and clipped) or float16. By default
+                       float32, or uint16 for whole number intensities when float32 does not fit memory_budget
+                       (see compact.ChooseStackDtype)
+        memory_budget (int): optional number of bytes the stack may use, a MemoryError is raised if it cannot fit
+    Returns:
+        array: read-only (n_emitters, H, W) array of projection intensities
+    '''
+    def Accept(stack):
+        if stack.shape[0] != len(paths):
+            return False
+        if dtype is not None:
+            return stack.dtype == dtype
+        if memory_budget is None:
+            return stack.dtype == np.float32
+        return stack.dtype in compact.BUDGET_DTYPES and stack.nbytes <= memory_budget
+
+    if cache_file is not None and os.path.isfile(cache_file) and not any(isinstance(path, np.ndarray) for path in paths):
+        newest = max(os.path.getmtime(path) for path in paths)
+        if os.path.getmtime(cache_file) >= newest:
+            stack = np.load(cache_file, mmap_mode='r')
+            if Accept(stack):
+                return stack
+    images = (np.squeeze(path) if isinstance(path, np.ndarray)
+              else np.squeeze(itk.GetArrayFromImage(itk.imread(path, itk.F))) for path in paths)
+    stack = compact.FillStack(images, len(paths), dtype, memory_budget)
+    if cache_file is not None:
+        np.save(cache_file, stack)
+        return np.load(cache_file, mmap_mode='r')
+    stack.flags.writeable = False
+    return stack
+
+
+def CTProjectionTransform(y):
+    '''
+    Construct the PythonVersorRigid3DPerspectiveTransform class used to project CT points, centered on the detector
+    Parameters:
+        y (array): nx3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+    Returns:
+        class: constructed PythonVersorRigid3DPerspectiveTransform class for the first emitter position
+        array: nx3 array of the emitter positions in CT projection space
     '''
-    # Set up VersorRigid3DPerspectiveTransform for projecting CT Data
     CenterOfRotation = np.array([0, 0, 0])                     # not used in the transform point (using center of field)
     PlaneCenter = np.array([0, 0, 0])                          # center of detector
     PlaneNormal = np.array([0, 0, 1])                          # vector normal
     xDirection = np.array([1, 0, 0])                           # vector x direction
     yDirection = np.array([0, 1, 0])                           # vector y direction
-    count = 1
-    for line, i in zip(y, range(len(y))):
-        new_points = []
-        EmitterPosition = [-line[0], line[1], line[2]]
-        # update projection class
-        ProjP = T.VersorRigid3DPerspectiveTransform(CenterOfRotation, EmitterPosition, 
-                                                    PlaneCenter, PlaneNormal, 
-                                                    xDirection, yDirection) 
-        # project point
-        # make blank array with Tomo Projection size
-        array = np.zeros(shape=[size[1], size[0]], dtype=np.uint8)
-        for point3D in source:
-            projected,_ ,_ = ProjP.TransformPoint(np.array([point3D[0], point3D[1], point3D[2]]))
-            projected_point = [projected[0]/(spacing*0.194)+size[0]/2, projected[1]/(spacing*0.194)+size[1]/2]
-            new_points.append(projected_point)
-        for point in new_points:
-            if point[0]>=1536:
-                None
-            elif point[0]<0:
-                None
-            elif point[1]>=2048:
-                None
-            elif point[1]<0:
-                None
-            else:
-                ind_1lb = int(point[1])-3
-                ind_1ub = int(point[1])+3
-                ind_2lb = int(point[0])-3
-                ind_2ub = int(point[0])+3
-                array[ind_1lb:ind_1ub, ind_2lb:ind_2ub] = 255
-
-        print("line {} of 29 complete".format(count))
-        count = count + 1
-        img = itk.GetImageFromArray(array)
-        new_suffix = f'{i+1:02}.dcm'
-        itk.imwrite(img, destDir+"/vessOverlay_"+new_suffix)
-
-
-def CT_TomoProjectionRegistration(x, u, y, mask, x_scale, size, spacing):
+    EmitterPositions = np.array([[-line[0], line[1], line[2]] for line in y], dtype=float)
+    ProjP = T.VersorRigid3DPerspectiveTransform(CenterOfRotation, EmitterPositions[0], 
+                                                PlaneCenter, PlaneNormal,
+                                                xDirection, yDirection) 
+    return ProjP, EmitterPositions
+
+
+def ProjectCTPointChunks(blocks, y, size, spacing):
+    '''
+    Project a stream of point blocks for every emitter position, one block at a time
+    Parameters:
+        blocks (iterable): (points, radii) blocks, from ChunkPoints or IterVesselCenterlines (radii may be None)
+        y (array): ex3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+    Returns:
+        generator: (projected, t, radii) per block, exmx2 pixel coordinates (column, row), exm t values of
+                   TransformPointsMultiEmitter and the radii of the block
+    '''
+    ProjP, EmitterPositions = CTProjectionTransform(y)
+    for points, radii in blocks:
+        projected, _, t = ProjP.TransformPointsMultiEmitter(points, EmitterPositions)
+        yield projected/(spacing*0.194) + np.array([size[0]/2, size[1]/2], dtype=projected.dtype), t, radii
+
+
+def ProjectCTPoints(x, u, y, size, spacing):
+    '''
+    Transform 3D CT points with the 6 parameters and project them for every emitter position
+    Parameters:
+        x (array): 1x6 array where the inputs define the x translation, y translation
+                   z translation, z rotation, y rotation and x rotation respectively
+        u (array): nx3 array of 3D CT source points
+        y (array): ex3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+    Returns:
+        array: exnx2 array of projected pixel coordinates (column, row) per emitter position and point
+    '''
+    ProjP, EmitterPositions = CTProjectionTransform(y)
+    # transform the points once, then project every point for every emitter position in one call
+    with telemetry.Stage('transform'):
+        transformed = TransformAllPointsAllParameters(x, u)
+    with telemetry.Stage('project'):
+        projected, _, _ = ProjP.TransformPointsMultiEmitter(transformed, EmitterPositions)
+        return projected/(spacing*0.194) + np.array([size[0]/2, size[1]/2], dtype=projected.dtype)
+
+
+@telemetry.Timed('project_jacobian')
+def ProjectCTPointsJacobian(x, u, y, size, spacing):
+    '''
+    Analytic derivative of ProjectCTPoints with respect to the 6 parameters
+    Parameters:
+        x (array): 1x6 array where the inputs define the x translation, y translation
+                   z translation, z rotation, y rotation and x rotation respectively
+        u (array): nx3 array of 3D CT source points
+        y (array): ex3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+    Returns:
+        array: exnx2x6 array of the derivatives of the projected pixel coordinates
+    '''
+    ProjP, EmitterPositions = CTProjectionTransform(y)
+    transformed = TransformAllPointsAllParameters(x, u)
+    # chain rule: d(pixel)/d(x) = d(pixel)/d(uv) * d(uv)/d(point) * d(point)/d(x)
+    jacobianPosition = ProjP.ComputeJacobianWithRespectToPositionMultiEmitter(transformed, EmitterPositions)
+    jacobianParameters = R.RigidJacobian(x, u)
+    return jacobianPosition @ jacobianParameters[np.newaxis] / (spacing*0.194)
+
+
+@telemetry.Timed('sample')
+def SampleProjections(mask, projected, gradient=False, interpolation='bilinear', outside=0, policy='zero', penalty=0,
+                      return_valid=False, occupancy=None):
+    '''
+    Sample every projection image at its projected points
+    Parameters:
+        mask (array): (n_emitters, H, W) projection stack from LoadProjectionStack
+        projected (array): exnx2 array of pixel coordinates (column, row) per emitter position and point
+        gradient (bool): also return the derivative of the sampled values with respect to the pixel coordinates
+                         (bilinear interpolation only)
+        interpolation (string): 'bilinear', or 'nearest' to truncate to whole pixels like the original objective
+                                (which also treats the first row and column as outside of the image)
+        outside (float or array): value sampled by points outside of the image, a scalar or an ex1 array per emitter
+        policy (string): points outside of the image sample 'zero' the outside value, 'clamp' the nearest border
+                         pixel, or 'penalty' the outside value plus penalty times their distance to the image in pixels
+        penalty (float): change of the sampled value per pixel outside of the image for the 'penalty' policy
+                         (negative for intensities, where lower is worse, positive for cost maps)
+        return_valid (bool): also return which points were inside of the image
+        occupancy (class): optional culling.OccupancyGrid of mask, with the 'zero' policy only the points in
+                           occupied blocks read the stack, the others sample 0 (empty masked regions)
+    Returns:
+        array: exn array of sampled intensities
+        array: exnx2 array of intensity derivatives with respect to (column, row), only if gradient is True
+        array: exn boolean array, True for the points inside of the image, only if return_valid is True
+    '''
+    if policy not in ('zero', 'clamp', 'penalty'):
+        raise ValueError("policy must be 'zero', 'clamp' or 'penalty', got {}".format(policy))
+    emitter = np.arange(len(projected))[:, np.newaxis]
+    if occupancy is None or policy != 'zero':
+        return _SampleProjections(mask, projected, emitter, gradient, interpolation, outside, policy, penalty,
+                                  return_valid)
+    # only the points in occupied blocks are sampled, the others read 0 inside of the image and outside elsewhere
+    index = np.nonzero(occupancy.Occupied(projected))
+    sampled = _SampleProjections(mask, projected[index], index[0], gradient, interpolation, 0, policy, penalty, True)
+    valid = _InsideImage(projected, mask.shape[1:3], interpolation)
+    values = np.where(valid, 0.0, outside)
+    values[index] = np.where(sampled[-1], sampled[0], values[index])
+    returns = (values,)
+    if gradient and interpolation != 'nearest':
+        gradients = np.zeros(values.shape + (2,))
+        gradients[index] = sampled[1]
+        returns += (gradients,)
+    if return_valid:
+        returns += (valid,)
+    return returns[0] if len(returns) == 1 else returns
+
+
+def _InsideImage(projected, shape, interpolation):
+    # points that sample the image: whole pixels from the second row and column on for 'nearest' (as the original
+    # objective), a 2x2 neighbourhood inside of the image for 'bilinear'
+    height, width = shape
+    col = projected[..., 0]
+    row = projected[..., 1]
+    if interpolation == 'nearest':
+        return (col >= 1) & (col < width) & (row >= 1) & (row < height)
+    return (col >= 0) & (col <= width-1) & (row >= 0) & (row <= height-1)
+
+
+def _SampleProjections(mask, projected, emitter, gradient, interpolation, outside, policy, penalty, return_valid):
+    # SampleProjections of the points with the given emitter position indices
+    height, width = mask.shape[1:3]
+    col = projected[..., 0]
+    row = projected[..., 1]
+    # whole pixel samples have no gradient
+    gradient = gradient and interpolation != 'nearest'
+    # compact stacks are sampled as floats, differences of uint16 samples would wrap around
+    sampleType = np.promote_types(mask.dtype, np.float32)
+    if interpolation == 'nearest':
+        low, colHigh, rowHigh = 1, np.nextafter(width, 0), np.nextafter(height, 0)
+    else:
+        low, colHigh, rowHigh = 0, width-1, height-1
+    valid = _InsideImage(projected, (height, width), interpolation)
+    if policy == 'clamp':
+        # sample the border, the value does not change along a clamped axis
+        clampedCol = (col < low) | (col > colHigh)
+        clampedRow = (row < low) | (row > rowHigh)
+        col = np.clip(col, low, colHigh)
+        row = np.clip(row, low, rowHigh)
+    if interpolation == 'nearest':
+        inside = valid | (policy == 'clamp')
+        col0 = np.where(inside, col, 0).astype(np.intp)
+        row0 = np.where(inside, row, 0).astype(np.intp)
+        values = mask[emitter, row0, col0].astype(sampleType)
+    else:
+        # clamp so that the 2x2 neighbourhood always lies inside the image
+        col0 = np.clip(np.floor(col), 0, width-2).astype(np.intp)
+        row0 = np.clip(np.floor(row), 0, height-2).astype(np.intp)
+        inside = valid | (policy == 'clamp')
+        fc = np.where(inside, col - col0, 0)
+        fr = np.where(inside, row - row0, 0)
+        i00 = mask[emitter, row0, col0].astype(sampleType)
+        i01 = mask[emitter, row0, col0+1].astype(sampleType)
+        i10 = mask[emitter, row0+1, col0].astype(sampleType)
+        i11 = mask[emitter, row0+1, col0+1].astype(sampleType)
+        values = (1-fc)*(1-fr)*i00 + fc*(1-fr)*i01 + (1-fc)*fr*i10 + fc*fr*i11
+        if gradient:
+            gradients = np.empty(values.shape + (2,))
+            gradients[..., 0] = (1-fr)*(i01-i00) + fr*(i11-i10)
+            gradients[..., 1] = (1-fc)*(i10-i00) + fc*(i11-i01)
+    if policy == 'clamp':
+        if gradient:
+            gradients[..., 0][clampedCol] = 0
+            gradients[..., 1][clampedRow] = 0
+    elif policy == 'penalty':
+        # distance to the image border in pixels, grows the further a point leaves the image
+        dc = np.maximum(low - col, 0) - np.maximum(col - colHigh, 0)
+        dr = np.maximum(low - row, 0) - np.maximum(row - rowHigh, 0)
+        distance = np.hypot(dc, dr)
+        values = np.where(valid, values, outside + penalty*distance)
+        if gradient:
+            scale = np.where(valid, 0, -penalty/np.maximum(distance, 1e-12))
+            gradients[..., 0] = np.where(valid, gradients[..., 0], scale*dc)
+            gradients[..., 1] = np.where(valid, gradients[..., 1], scale*dr)
+    else:
+        values = np.where(valid, values, outside)
+        if gradient:
+            gradients[~valid] = 0
+    returns = (values,)
+    if gradient:
+        returns += (gradients,)
+    if return_valid:
+        returns += (valid,)
+    return returns[0] if len(returns) == 1 else returns
+
+
+def _VisibleCTPoints(x, u, y, size, spacing, tube_bounds):
+    # points of the segments whose bounding sphere reaches the detector of at least one emitter position
+    ProjP, EmitterPositions = CTProjectionTransform(y)
+    with telemetry.Stage('cull'):
+        keep = tube_bounds.AnyVisible(culling.DetectorFrustums(ProjP, EmitterPositions, size, spacing), x)
+    telemetry.Count('culled_points', len(keep) - np.count_nonzero(keep))
+    return keep
+
+
+def SampleCTPoints(x, u, y, mask, size, spacing, interpolation='bilinear', outside=0, policy='zero', penalty=0,
+                   return_valid=False, tube_bounds=None, occupancy=None):
+    '''
+    Sampled projection intensity of every transformed CT point at every emitter position
+    Parameters:
+        x (array): 1x6 array where the inputs define the x translation, y translation
+                   z translation, z rotation, y rotation and x rotation respectively
+        u (array): nx3 array of 3D CT source points
+        y (array): ex3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        mask (array): (e, H, W) projection stack, one image per emitter position in y
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+        interpolation (string): 'bilinear' or 'nearest', see SampleProjections
+        outside (float or array): value sampled by points projected outside of the image, see SampleProjections
+        policy (string): 'zero', 'clamp' or 'penalty' handling of points outside of the image, see SampleProjections
+        penalty (float): change of the sampled value per pixel outside of the image, see SampleProjections
+        return_valid (bool): also return the exn boolean array of the points projected inside of the image
+        tube_bounds (class): optional culling.TubeBounds of u, with the 'zero' policy the segments that project off the
+                             detector at every emitter position are not projected (they sample the outside value)
+        occupancy (class): optional culling.OccupancyGrid of mask, see SampleProjections
+    Returns:
+        array: exn array of sampled intensities
+    '''
+    if tube_bounds is None or policy != 'zero':
+        projected = ProjectCTPoints(x, u, y, size, spacing)
+        return SampleProjections(mask[:len(projected)], projected, interpolation=interpolation, outside=outside,
+                                 policy=policy, penalty=penalty, return_valid=return_valid, occupancy=occupancy)
+    keep = _VisibleCTPoints(x, u, y, size, spacing, tube_bounds)
+    projected = ProjectCTPoints(x, np.asarray(u)[keep], y, size, spacing)
+    sampled = SampleProjections(mask[:len(projected)], projected, interpolation=interpolation, outside=outside,
+                                return_valid=True, occupancy=occupancy)
+    # same dtype as the unculled path, float32 samples stay float32
+    values = np.empty((len(projected), len(keep)), dtype=sampled[0].dtype)
+    values[:] = outside
+    values[:, keep] = sampled[0]
+    if not return_valid:
+        return values
+    valid = np.zeros(values.shape, dtype=bool)
+    valid[:, keep] = sampled[1]
+    return values, valid
+
+
+def SampleCTPointsJacobian(x, u, y, mask, size, spacing, outside=0, policy='zero', penalty=0, tube_bounds=None,
+                           occupancy=None):
+    '''
+    Derivative of the bilinearly sampled intensities of SampleCTPoints with respect to the 6 parameters
+    Parameters:
+        same as SampleCTPoints
+    Returns:
+        array: exnx6 array of intensity derivatives
+    '''
+    if tube_bounds is not None and policy == 'zero':
+        # culled points sample the constant outside value, their derivative is zero
+        keep = _VisibleCTPoints(x, u, y, size, spacing, tube_bounds)
+        visible = SampleCTPointsJacobian(x, np.asarray(u)[keep], y, mask, size, spacing, outside, occupancy=occupancy)
+        jacobian = np.zeros((len(y), len(keep), 6), dtype=visible.dtype)
+        jacobian[:, keep] = visible
+        return jacobian
+    projected = ProjectCTPoints(x, u, y, size, spacing)
+    _, gradients = SampleProjections(mask[:len(projected)], projected, gradient=True, outside=outside,
+                                     policy=policy, penalty=penalty, occupancy=occupancy)
+    jacobianProjected = ProjectCTPointsJacobian(x, u, y, size, spacing)
+    return np.einsum('enk,enkj->enj', gradients, jacobianProjected)
+
+
+def CT_TomoProjectionRegistrationResiduals(x, u, y, mask, x_scale, size, spacing, per='pair', interpolation='bilinear',
+                                           policy='zero', penalty=0, tube_bounds=None, occupancy=None):
+    '''
+    Residual vector form of CT_TomoProjectionRegistration, so least_squares sees one residual per
+    (emitter position, point) pair or per emitter position instead of a single scalar
+    Parameters:
+        x (array): 1x6 array of the scaled parameters (x translation, y translation, z translation,
+                   z rotation, y rotation, x rotation)
+        u (array): nx3 array of 3D CT source points
+        y (array): ex3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        mask (array): (n_emitters, H, W) projection stack from LoadProjectionStack, or a list of image paths
+        x_scale (array): 1x6 array of the parameter scales
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+        per (string): 'pair' for e*n residuals (emitter major), 'emitter' for e residuals averaged over the points
+        interpolation (string): 'bilinear' or 'nearest', see SampleProjections
+        policy (string): points projected outside of the image sample 'zero', the 'clamp'ed border, or a
+                         'penalty' that grows with their distance to the image, see SampleProjections
+        penalty (float): residual increase per pixel outside of the image for the 'penalty' policy
+        tube_bounds (class): optional culling.TubeBounds of u, segments off the detector are not projected
+        occupancy (class): optional culling.OccupancyGrid of mask, empty blocks are not sampled
+    Returns:
+        array: residuals, 6000 minus the sampled voxel value(s)
+    '''
+    if not isinstance(mask, np.ndarray):
+        mask = LoadProjectionStack(mask)
+    telemetry.Count('evaluations')
+    # a lower intensity is a larger residual
+    values = SampleCTPoints(x/x_scale, u, y, mask, size, spacing, interpolation, policy=policy, penalty=-penalty,
+                            tube_bounds=tube_bounds, occupancy=occupancy)
+    with telemetry.Stage('reduce'):
+        if per == 'emitter':
+            residuals = 6000 - values.mean(axis=1)
+        else:
+            residuals = 6000 - values.ravel()
+    if telemetry.Enabled():
+        # same cost as reported by least_squares
+        telemetry.Cost(0.5*np.dot(residuals, residuals), x/x_scale)
+    return residuals
+
+
+def CT_TomoProjectionRegistrationResidualsJacobian(x, u, y, mask, x_scale, size, spacing, per='pair', interpolation='bilinear',
+                                                   policy='zero', penalty=0, tube_bounds=None, occupancy=None):
+    '''
+    Analytic Jacobian of CT_TomoProjectionRegistrationResiduals (bilinear interpolation) with respect to the scaled parameters
+    Parameters:
+        same as CT_TomoProjectionRegistrationResiduals
+    Returns:
+        array: (e*n)x6 or ex6 Jacobian, matching the residuals
+    '''
+    if interpolation != 'bilinear':
+        raise ValueError("the analytic Jacobian requires bilinear interpolation")
+    if not isinstance(mask, np.ndarray):
+        mask = LoadProjectionStack(mask)
+    telemetry.Count('jacobian_evaluations')
+    # d(intensity)/d(x) per emitter and point, scaled since the optimizer works on x*x_scale
+    jacobian = -SampleCTPointsJacobian(x/x_scale, u, y, mask, size, spacing, policy=policy, penalty=-penalty,
+                                       tube_bounds=tube_bounds, occupancy=occupancy) / x_scale
+    if per == 'emitter':
+        return jacobian.mean(axis=1)
+    return jacobian.reshape(-1, 6)
+
+
+def CT_TomoProjectionRegistrationBilinear(x, u, y, mask, x_scale, size, spacing):
+    '''
+    Same cost as CT_TomoProjectionRegistration, but the projected points are sampled bilinearly so the cost
+    is differentiable and can be paired with CT_TomoProjectionRegistrationJacobian as the jac of least_squares
+    Parameters:
+        x (array): 1x6 array of the scaled parameters (x translation, y translation, z translation,
+                   z rotation, y rotation, x rotation)
+        u (array): 3D CT source points
+        y (array): nx3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        mask (array): (n_emitters, H, W) projection stack from LoadProjectionStack, or a list of image paths
+        x_scale (array): 1x6 array of the parameter scales
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+    Returns:
+        float: 6000 minus the average interpolated voxel value over all points and emitter positions
+    '''
+    return np.mean(CT_TomoProjectionRegistrationResiduals(x, u, y, mask, x_scale, size, spacing, per='emitter'))
+
+
+def CT_TomoProjectionRegistrationJacobian(x, u, y, mask, x_scale, size, spacing):
+    '''
+    Analytic Jacobian of CT_TomoProjectionRegistrationBilinear with respect to the scaled parameters
+    Parameters:
+        same as CT_TomoProjectionRegistrationBilinear
+    Returns:
+        array: 1x6 Jacobian
+    '''
+    jacobian = CT_TomoProjectionRegistrationResidualsJacobian(x, u, y, mask, x_scale, size, spacing, per='emitter')
+    return jacobian.mean(axis=0)[np.newaxis]
+
+
+def MakeCostMap(image, kind='distance', sigmas=(2, 4, 8)):
+    '''
+    Turn one masked projection into a smooth cost map that is 0 on the vessels and grows away from them
+    Parameters:
+        image (array): HxW masked tomosynthesis projection, 0 outside of the vessel mask
+        kind (string): 'distance' for the distance in pixels to the nearest masked pixel, or 'blur' for the
+                       maximum intensity minus the masked image blurred at each sigma (averaged over the sigmas)
+        sigmas (list): Gaussian sigmas in pixels used by the 'blur' cost map
+    Returns:
+        array: HxW float32 cost map
+    '''
+    image = np.asarray(image, dtype=np.float32)
+    if kind == 'distance':
+        return ndimage.distance_transform_edt(image == 0).astype(np.float32)
+    if kind == 'blur':
+        blurred = np.mean([ndimage.gaussian_filter(image, sigma) for sigma in sigmas], axis=0)
+        return (blurred.max() - blurred).astype(np.float32)
+    raise ValueError("kind must be 'distance' or 'blur', got {}".format(kind))
+
+
+def MakeCostMaps(mask, destDir, kind='distance', sigmas=(2, 4, 8)):
+    '''
+    Write a cost map for every masked projection, skipping maps that are newer than their masked projection.
+    The file names hold the parameters of the maps, so maps of another kind or other sigmas are never reused
+    Parameters:
+        mask (list): list of strings of the location of the masked projection images (maskedTomo_XX.mha)
+        destDir (string): directory where the costMap_<kind>_XX.mha (distance) or costMap_blur_<sigmas>_XX.mha
+                          files are written (next to the masked projections)
+        kind (string): 'distance' or 'blur', see MakeCostMap
+        sigmas (list): Gaussian sigmas in pixels used by the 'blur' cost map
+    Returns:
+        list: list of strings of the location of the cost map images, load them with LoadProjectionStack
+    '''
+    if kind not in ('distance', 'blur'):
+        raise ValueError("kind must be 'distance' or 'blur', got {}".format(kind))
+    # the distance map does not depend on the sigmas
+    parameters = kind if kind == 'distance' else kind + "_" + "-".join("{:g}".format(sigma) for sigma in sigmas)
+    cost_list = []
+    for path, i in zip(mask, range(len(mask))):
+        file_name = destDir+"/costMap_{}_{}.mha".format(parameters, f'{i+1:02}')
+        if not os.path.isfile(file_name) or os.path.getmtime(file_name) < os.path.getmtime(path):
+            im = np.squeeze(itk.GetArrayFromImage(itk.imread(path, itk.F)))
+            itk.imwrite(itk.GetImageFromArray(MakeCostMap(im, kind, sigmas)), file_name)
+        cost_list.append(file_name)
+    return cost_list
+
+
+def CT_TomoProjectionRegistrationCostMap(x, u, y, costMaps, x_scale, size, spacing, per='pair'):
+    '''
+    Residuals that sample the cost maps from MakeCostMaps at the projected points, so the optimizer sees a smooth
+    landscape instead of the flat zero region around the hard-edged masks. Points projected outside of the image
+    get the largest cost of their map
+    Parameters:
+        x (array): 1x6 array of the scaled parameters (x translation, y translation, z translation,
+                   z rotation, y rotation, x rotation)
+        u (array): nx3 array of 3D CT source points
+        y (array): ex3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        costMaps (array): (e, H, W) cost map stack from LoadProjectionStack, or a list of cost map paths
+        x_scale (array): 1x6 array of the parameter scales
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+        per (string): 'pair' for e*n residuals (emitter major), 'emitter' for e residuals averaged over the points
+    Returns:
+        array: residuals, the bilinearly sampled cost
+    '''
+    if not isinstance(costMaps, np.ndarray):
+        costMaps = LoadProjectionStack(costMaps)
+    costMaps = costMaps[:len(y)]
+    outside = costMaps.max(axis=(1, 2))[:, np.newaxis]
+    telemetry.Count('evaluations')
+    values = SampleCTPoints(x/x_scale, u, y, costMaps, size, spacing, outside=outside)
+    with telemetry.Stage('reduce'):
+        if per == 'emitter':
+            residuals = values.mean(axis=1)
+        else:
+            residuals = values.ravel()
+    if telemetry.Enabled():
+        telemetry.Cost(0.5*np.dot(residuals, residuals), x/x_scale)
+    return residuals
+
+
+def CT_TomoProjectionRegistrationCostMapJacobian(x, u, y, costMaps, x_scale, size, spacing, per='pair'):
+    '''
+    Analytic Jacobian of CT_TomoProjectionRegistrationCostMap with respect to the scaled parameters
+    Parameters:
+        same as CT_TomoProjectionRegistrationCostMap
+    Returns:
+        array: (e*n)x6 or ex6 Jacobian, matching the residuals
+    '''
+    if not isinstance(costMaps, np.ndarray):
+        costMaps = LoadProjectionStack(costMaps)
+    telemetry.Count('jacobian_evaluations')
+    jacobian = SampleCTPointsJacobian(x/x_scale, u, y, costMaps, size, spacing) / x_scale
+    if per == 'emitter':
+        return jacobian.mean(axis=1)
+    return jacobian.reshape(-1, 6)
+
+
+def ProjectCTPointsBatch(X, u, y, size, spacing):
+    '''
+    Batched ProjectCTPoints: transform the 3D CT points with K parameter vectors and project all of them
+    for every emitter position in a single call
+    Parameters:
+        X (array): Kx6 array of parameter vectors (x translation, y translation, z translation,
+                   z rotation, y rotation, x rotation)
+        u (array): nx3 array of 3D CT source points
+        y (array): ex3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+    Returns:
+        array: exKxnx2 array of projected pixel coordinates (column, row) per emitter position, pose and point
+    '''
+    X = np.asarray(X, dtype=float).reshape(-1, 6)
+    ProjP, EmitterPositions = CTProjectionTransform(y)
+    transformed = R.TransformPoints(X, u)
+    projected, _, _ = ProjP.TransformPointsMultiEmitter(transformed.reshape(-1, 3), EmitterPositions)
+    projected = projected/(spacing*0.194) + np.array([size[0]/2, size[1]/2], dtype=projected.dtype)
+    return projected.reshape(len(EmitterPositions), len(X), -1, 2)
+
+
+def CT_TomoProjectionRegistrationBatch(X, u, y, mask, x_scale, size, spacing, interpolation='nearest', chunk=64):
+    '''
+    Score K candidate poses at once with the CT_TomoProjectionRegistration cost
+    Parameters:
+        X (array): Kx6 array of the scaled parameters (x*x_scale per row)
+        u (array): nx3 array of 3D CT source points
+        y (array): ex3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        mask (array): (e, H, W) projection stack from LoadProjectionStack, or a list of image paths
+        x_scale (array): 1x6 array of the parameter scales
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+        interpolation (string): 'nearest' (same cost as CT_TomoProjectionRegistration) or 'bilinear'
+        chunk (int): number of poses projected together, bounds the e*chunk*n projected coordinates held at once
+    Returns:
+        array: K costs, 6000 minus the average voxel value of the projected points per pose
+    '''
+    if not isinstance(mask, np.ndarray):
+        mask = LoadProjectionStack(mask)
+    X = np.asarray(X, dtype=float).reshape(-1, 6) / x_scale
+    u = np.asarray(u, dtype=float)
+    telemetry.Count('batch_poses', len(X))
+    costs = np.empty(len(X))
+    for start in range(0, len(X), chunk):
+        projected = ProjectCTPointsBatch(X[start:start+chunk], u, y, size, spacing)
+        emitters, poses = projected.shape[:2]
+        # sample the poses of an emitter position as one long row of points
+        values = SampleProjections(mask[:emitters], projected.reshape(emitters, -1, 2), interpolation=interpolation)
+        # mean over the points, then over the emitter positions, as in CT_TomoProjectionRegistration
+        costs[start:start+chunk] = 6000 - values.reshape(emitters, poses, -1).mean(axis=2).mean(axis=0)
+    return costs
+
+
+def CandidatePoses(center, halfWidth, samples, method='lhs', seed=None):
+    '''
+    Candidate poses around a center pose for GlobalSearch
+    Parameters:
+        center (array): 1x6 center pose
+        halfWidth (array): 1x6 half width of the search range per parameter (0 keeps the parameter at the center)
+        samples (int or list): 'lhs': number of poses. 'grid': number of values per parameter (an int for every
+                               searched parameter, or one count per parameter)
+        method (string): 'lhs' for a Latin hypercube sample of the box, 'grid' for a regular grid
+        seed (int): random seed of the Latin hypercube
+    Returns:
+        array: Kx6 array of poses
+    '''
+    center = np.ravel(np.asarray(center, dtype=float))
+    halfWidth = np.ravel(np.asarray(halfWidth, dtype=float)) * np.ones(6)
+    if method == 'grid':
+        counts = np.broadcast_to(samples, (6,))
+        axes = [np.linspace(c-w, c+w, int(n)) if w > 0 else np.array([c])
+                for c, w, n in zip(center, halfWidth, counts)]
+        return np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 6)
+    if method != 'lhs':
+        raise ValueError("method must be 'lhs' or 'grid', got {}".format(method))
+    rng = np.random.default_rng(seed)
+    # one sample per stratum and parameter, strata shuffled independently per parameter
+    strata = np.argsort(rng.random((samples, 6)), axis=0)
+    unit = (strata + rng.random((samples, 6))) / samples
+    return center + (2*unit - 1)*halfWidth
+
+
+def _RefineCandidate(x, u, y, mask, x_scale, size, spacing, options):
+    return least_squares(CT_TomoProjectionRegistrationResiduals, x, jac=CT_TomoProjectionRegistrationResidualsJacobian,
+                         args=(u, y, mask, x_scale, size, spacing), **options)
+
+
+def GlobalSearch(x0, source, y, mask, x_scale, size, spacing, halfWidth, samples=256, method='lhs', top=4,
+                 stride=1, backend='thread', workers=None, seed=None, **kwargs):
+    '''
+    Two stage global search: score a sweep of candidate poses around x0 in batched calls, then refine the
+    best candidates with least_squares in parallel and keep the lowest cost result
+    Parameters:
+        x0 (array): 1x6 array of the scaled initial parameters (x*x_scale), always one of the candidates
+        source (array): nx3 array of 3D CT source points
+        y (array): ex3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        mask (array): (e, H, W) projection stack from LoadProjectionStack, or a list of image paths
+        x_scale (array): 1x6 array of the parameter scales
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+        halfWidth (array): 1x6 half width of the search range per parameter, in parameter units (mm and radians)
+        samples (int or list): number of candidates, see CandidatePoses
+        method (string): 'lhs' or 'grid', see CandidatePoses
+        top (int): number of best scoring candidates refined with least_squares
+        stride (int): CT point stride used to score the candidates (refinement uses every point)
+        backend (string): 'thread', 'process' (stack and points in shared memory, see parallel.RefineCandidates)
+                          or 'serial' refinement of the candidates
+        workers (int): number of refinement workers, defaults to top
+        seed (int): random seed of the Latin hypercube
+        **kwargs: options passed to every least_squares call (bounds, max_nfev, ...), max_nfev bounds the run time
+    Returns:
+        OptimizeResult: lowest cost least_squares result
+        list: least_squares result of every refined candidate, best first
+        array: Kx6 array of the scaled candidate poses
+        array: K candidate costs (CT_TomoProjectionRegistration)
+    '''
+    if not isinstance(mask, np.ndarray):
+        mask = LoadProjectionStack(mask)
+    x0 = np.asarray(x0, dtype=float)
+    x_scale = np.asarray(x_scale, dtype=float)
+    candidates = CandidatePoses(x0/x_scale, halfWidth, samples, method, seed)
+    candidates = np.vstack([x0/x_scale, candidates]) * x_scale
+    scores = CT_TomoProjectionRegistrationBatch(candidates, np.asarray(source)[::stride], y, mask, x_scale, size, spacing)
+    best = candidates[np.argsort(scores, kind='stable')[:top]]
+    args = (source, y, mask, x_scale, size, spacing, kwargs)
+    if backend == 'serial':
+        results = [_RefineCandidate(x, *args) for x in best]
+    elif backend == 'thread':
+        with ThreadPoolExecutor(max_workers=workers or len(best)) as executor:
+            results = list(executor.map(lambda x: _RefineCandidate(x, *args), best))
+    elif backend == 'process':
+        # the stack and the points go to the workers once through shared memory, not once per candidate
+        import parallel
+        results = parallel.RefineCandidates(best, source, y, mask, x_scale, size, spacing, kwargs, workers)
+    else:
+        raise ValueError("backend must be 'serial', 'thread' or 'process', got {}".format(backend))
+    results.sort(key=lambda res: res.cost)
+    return results[0], results, candidates, scores
+
+
+def CT_TomoProjectionRegistration(x, u, y, mask, x_scale, size, spacing, tube_bounds=None, occupancy=None):
     '''
     For each point and emitter position, evaluate projected point based on voxel intensity.
-    Optimization wants to align points with greatest average voxel vals
+    Optimization wants to align points with greatest average voxel vals.
+    Scalar reduction of CT_TomoProjectionRegistrationResiduals with nearest interpolation
     Parameters:
         x (array): 1x6 array where the inputs define the x translation, y translation
                    z translation, z rotation, y rotation and x rotation respectively
         u (array): 3D CT source points
         y (array): nx3 array that contains an emitter position per line (most likely one line of the geo.txt file)
-        mask (list): list of strings of the location of the images to register the source points with
+        mask (array): (n_emitters, H, W) projection stack from LoadProjectionStack, or a list of strings of the
+                      location of the images to register the source points with (read once per call)
         x_scale (array): 1x6 array where the inputs define the x translation, y translation
                          z translation, z rotation, y rotation and x rotation scales respectively
         size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
         spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+        tube_bounds (class): optional culling.TubeBounds of u, segments off the detector are not projected,
+                             through least_squares as kwargs={'tube_bounds': ...}
+        occupancy (class): optional culling.OccupancyGrid of mask, empty blocks are not sampled
     Returns:
         int: 6000 minus the average voxel value of the projected points average voxel values at each emitter position
     '''
-    CenterOfRotation = np.array([0, 0, 0])                     # not used in the transform point (using center of field)
-    PlaneCenter = np.array([0, 0, 0])                          # center of detector
-    PlaneNormal = np.array([0, 0, 1])                          # vector normal
-    xDirection = np.array([1, 0, 0])                           # vector x direction
-    yDirection = np.array([0, 1, 0])                           # vector y direction
-    totVal = 0
-    count = 1
-    for point in u:
-        voxVal = 0
-        for line, path in zip(y, mask):
-            EmitterPosition = [-line[0], line[1], line[2]]
-            # update projection class
-            ProjP = T.VersorRigid3DPerspectiveTransform(CenterOfRotation, EmitterPosition, 
-                                                        PlaneCenter, PlaneNormal,
-                                                        xDirection, yDirection) 
-            # project point
-            proj = modelCT(x/x_scale, point, ProjP, size, spacing)
-            # get val at projected voxel
-            im = itk.imread(path)
-            im.SetSpacing((0.194, 0.194))
-            im.Update()
-            # adjust for projections outside of index of tomo image
-            if int(proj[0]) >= size[0]:
-                print("out of bounds")
-            elif int(proj[1]) >= size[1]:
-                print("out of bounds")
-            elif int(proj[0]) <= 0:
-                print("out of bounds")
-            elif int(proj[1]) <= 0:
-                print("out of bounds")
-            elif im[int(proj[1]), int(proj[0])] == 0:
-                None
-            else:
-                voxVal = voxVal + im[int(proj[1]), int(proj[0])]
-        print("Optimized point {} of {}".format(count, len(u)))
-        count = count+1
-        totVal = totVal + voxVal/len(y)
-    returnVal = (6000 - totVal/len(u))
-    print (returnVal, x/x_scale)
-    return returnVal
\ No newline at end of file
+    if not isinstance(mask, np.ndarray):
+        mask = LoadProjectionStack(mask)
+    telemetry.Count('evaluations')
+    values, valid = SampleCTPoints(x/x_scale, u, y, mask, size, spacing, interpolation='nearest', return_valid=True,
+                                   tube_bounds=tube_bounds, occupancy=occupancy)
+    with telemetry.Stage('reduce'):
+        # mean over emitter positions of the per-emitter residuals (each averaged over the points)
+        returnVal = np.mean(6000 - values.mean(axis=1))
+    if telemetry.Enabled():
+        outOfBounds = valid.size - np.count_nonzero(valid)
+        telemetry.Count('out_of_bounds', outOfBounds)
+        telemetry.Cost(returnVal, x/x_scale, out_of_bounds=outOfBounds, points=valid.size)
+    return returnVal
+
+
+def MakeProjectionPyramid(mask, factors, sigmas=None):
+    '''
+    Gaussian smooth and decimate the masked projection stack once per pyramid level
+    Parameters:
+        mask (array): (n_emitters, H, W) projection stack from LoadProjectionStack
+        factors (list): decimation factor per level, a factor of 1 (without sigma) keeps the full resolution stack
+        sigmas (list): Gaussian sigma in full resolution pixels per level, defaults to half the decimation factor
+    Returns:
+        list: one read-only (n_emitters, ceil(H/factor), ceil(W/factor)) float32 stack per factor (the stack
+              itself, in its own dtype, for an unsmoothed factor of 1)
+    '''
+    if sigmas is None:
+        sigmas = [None]*len(factors)
+    pyramid = []
+    for factor, sigma in zip(factors, sigmas):
+        if sigma is None:
+            # half the decimation factor suppresses aliasing of the thin vessel masks
+            sigma = factor/2 if factor > 1 else 0
+        if sigma == 0 and factor == 1:
+            pyramid.append(mask)
+            continue
+        # one projection at a time, so a compact stack is never expanded to float32 as a whole
+        level = np.stack([ndimage.gaussian_filter(np.asarray(image, dtype=np.float32), sigma=sigma)[::factor, ::factor]
+                          for image in mask])
+        level.flags.writeable = False
+        pyramid.append(level)
+    return pyramid
+
+
+def PyramidRegistration(x0, source, y, mask, x_scale, size, spacing, levels=None, backend=None, workers=None,
+                        **kwargs):
+    '''
+    Coarse-to-fine registration: each level registers a stride subset of the CT points against a smoothed,
+    decimated copy of the projections and warm starts from the previous level's solution
+    Parameters:
+        x0 (array): 1x6 array of the scaled initial parameters (x*x_scale)
+        source (array): nx3 array of 3D CT source points, subsampled per level by the level's stride
+        y (array): ex3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        mask (array): (e, H, W) projection stack from LoadProjectionStack, or a list of image paths
+        x_scale (array): 1x6 array of the parameter scales
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+        levels (list): list of dicts with 'factor' (decimation) and 'stride' (point stride), optionally 'sigma'
+                       (see MakeProjectionPyramid) and least_squares options for that level such as 'max_nfev',
+                       defaults to PYRAMID_LEVELS
+        backend (string): optional parallel.EmitterPool backend ('serial', 'thread' or 'process') for the residuals
+        workers (int): number of EmitterPool workers
+        **kwargs: options passed to every least_squares call (bounds, method, verbose, ...)
+    Returns:
+        OptimizeResult: least_squares result of the finest level
+        list: least_squares result of every level, coarse to fine
+    '''
+    if levels is None:
+        levels = PYRAMID_LEVELS
+    if not isinstance(mask, np.ndarray):
+        mask = LoadProjectionStack(mask)
+    pyramid = MakeProjectionPyramid(mask, [level['factor'] for level in levels],
+                                    [level.get('sigma') for level in levels])
+    x = np.asarray(x0, dtype=float)
+    results = []
+    for level, stack in zip(levels, pyramid):
+        factor = level['factor']
+        options = dict(kwargs)
+        options.update({key: val for key, val in level.items() if key not in ('factor', 'stride', 'sigma')})
+        u = np.asarray(source)[::level['stride']]
+        # pixel coordinates shrink by the decimation factor: scale the detector size down and the spacing up
+        levelSize = (size[0]/factor, size[1]/factor)
+        levelSpacing = spacing*factor
+        if backend is None:
+            res = least_squares(CT_TomoProjectionRegistrationResiduals, x,
+                                jac=CT_TomoProjectionRegistrationResidualsJacobian,
+                                args=(u, y, stack, x_scale, levelSize, levelSpacing), **options)
+        else:
+            import parallel
+            with parallel.EmitterPool(u, y, stack, levelSize, levelSpacing, backend=backend, workers=workers) as pool:
+                res = least_squares(pool.Residuals, x, jac=pool.ResidualsJacobian, args=(x_scale,), **options)
+        results.append(res)
+        x = res.x
+    return results[-1], results
+
+
+# opt-in profiling of the whole run when CTTOMO_PROFILE is set, see profiling.py
+profiling.FromEnvironment()
@@ -0,0 +1,108 @@
+import os
+import uuid
+import threading
+import numpy as np
+import itk
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+def WriteImage(array, path, compression=False):
+    '''
+    Write an array as an image atomically: the image is written to a temporary file in the destination
+    directory, then renamed over path, so readers never see a partially written image
+    Parameters:
+        array (array): image array (numpy index order)
+        path (string): destination file, its extension selects the ITK ImageIO
+        compression (bool): ask the ImageIO to compress the pixel data
+    Returns:
+        string: path
+    '''
+    path = str(path)
+    directory, name = os.path.split(path)
+    stem, ext = os.path.splitext(name)
+    # keep the extension so ITK picks the same ImageIO for the temporary file
+    tmp = os.path.join(directory, ".{}-{}{}".format(stem, uuid.uuid4().hex, ext))
+    try:
+        itk.imwrite(itk.GetImageFromArray(np.ascontiguousarray(array)), tmp, compression=compression)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return path
+
+
+class ImageWriter:
+    '''
+    Bounded pool that serializes images in the background while the caller keeps working on the arrays
+    Parameters:
+        workers (int): number of writer workers
+        backend (string): 'process' (default) or 'thread' workers, 'serial' writes in the calling thread
+        compression (bool): ask the ImageIO to compress the pixel data
+        max_pending (int): maximum number of images queued or being written, Write blocks when it is reached,
+                           bounding the memory held by the queue (defaults to twice the number of workers)
+    Usage:
+        with ImageWriter() as writer:
+            for i, array in enumerate(arrays):
+                writer.Write(array, destDir+"/mask_{:02}.dcm".format(i+1))
+    '''
+    def __init__(self, workers=4, backend='process', compression=False, max_pending=None):
+        self.compression = compression
+        self.backend = backend
+        self._executor = None
+        if backend == 'thread':
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+        elif backend == 'process':
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+        elif backend != 'serial':
+            raise ValueError("backend must be 'serial', 'thread' or 'process', got {}".format(backend))
+        self._slots = threading.BoundedSemaphore(max_pending or 2*workers)
+        self._futures = []
+
+    def Write(self, array, path):
+        '''
+        Queue one image for writing
+        Parameters:
+            array (array): image array (numpy index order)
+            path (string): destination file
+        Returns:
+            array: the same array, so later stages can keep using it instead of reading the file back
+        '''
+        if self._executor is None:
+            WriteImage(array, path, self.compression)
+            return array
+        self._slots.acquire()
+        future = self._executor.submit(WriteImage, array, path, self.compression)
+        future.add_done_callback(lambda f: self._slots.release())
+        self._futures.append(future)
+        return array
+
+    def WriteAll(self, arrays, paths):
+        '''
+        Queue one image per path
+        Returns:
+            list: the arrays
+        '''
+        return [self.Write(array, path) for array, path in zip(arrays, paths)]
+
+    def Wait(self):
+        '''
+        Block until every queued image is written, raising the first write error
+        Returns:
+            list: paths of the written images
+        '''
+        futures, self._futures = self._futures, []
+        return [future.result() for future in futures]
+
+    def close(self):
+        try:
+            self.Wait()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from scipy.optimize import least_squares
+import functions as func
+
+
+def HashArrays(*arrays):
+    '''
+    Content hash of arrays (shapes, dtypes and values)
+    Returns:
+        string: SHA-1 hex digest
+    '''
+    sha = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        sha.update(str((array.shape, array.dtype.str)).encode())
+        sha.update(array.data)
+    return sha.hexdigest()
+
+
+def EmitterHashes(y, mask):
+    '''
+    One hash per emitter position of its geometry and its masked projection
+    Returns:
+        list: SHA-1 hex digests
+    '''
+    return [HashArrays(np.asarray(line, dtype=float), image) for line, image in zip(y, mask)]
+
+
+def LoadSolution(solution_file):
+    '''
+    Read a regSolution_XX.txt file written by the registration notebook
+    Returns:
+        array: 1x6 unscaled solution
+    '''
+    return np.loadtxt(solution_file, delimiter=',').ravel()
+
+
+def _Save(path, state):
+    # written next to the target and renamed over it, a crash never leaves a partial state file
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp, path)
+
+
+def LoadState(state_file):
+    '''
+    Returns:
+        dict: the registration state written by IncrementalRegistration, or None if there is none
+    '''
+    if state_file is None or not os.path.isfile(state_file):
+        return None
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def EmitterCosts(x, u, y, mask, x_scale, size, spacing):
+    '''
+    least_squares cost (half the sum of squared residuals) of every emitter position at the scaled pose x,
+    they add up to the cost of CT_TomoProjectionRegistrationResiduals
+    Returns:
+        array: e costs
+    '''
+    residuals = func.CT_TomoProjectionRegistrationResiduals(x, u, y, mask, x_scale, size, spacing)
+    return 0.5*np.sum(residuals.reshape(len(y), -1)**2, axis=1)
+
+
+class CheckpointedResiduals:
+    '''
+    Residual function wrapper that remembers the lowest cost pose evaluated so far and writes it to the
+    state file every few evaluations, so an interrupted refinement can warm start from its progress
+    Parameters:
+        fun (function): residual function, fun(x, *args)
+        state (dict): registration state, its 'checkpoint' entry is updated
+        state_file (string): path of the state file
+        x_scale (array): 1x6 parameter scales, checkpoints store unscaled poses
+        every (int): evaluations between checkpoints
+    '''
+    def __init__(self, fun, state, state_file, x_scale, every=10):
+        self.fun = fun
+        self.state = state
+        self.state_file = state_file
+        self.x_scale = np.asarray(x_scale, dtype=float)
+        self.every = every
+        self.nfev = 0
+        self.best = (np.inf, None)
+
+    def __call__(self, x, *args):
+        residuals = self.fun(x, *args)
+        self.nfev += 1
+        cost = 0.5*np.dot(residuals, residuals)
+        if cost < self.best[0]:
+            self.best = (cost, np.array(x, dtype=float))
+        if self.state_file is not None and self.nfev % self.every == 0:
+            self.Save()
+        return residuals
+
+    def Save(self):
+        cost, x = self.best
+        self.state['checkpoint'] = {'x': (x/self.x_scale).tolist(), 'cost': float(cost), 'nfev': self.nfev,
+                                    'time': time.time()}
+        _Save(self.state_file, self.state)
+
+
+def IncrementalRegistration(state_file, u, y, mask, x_scale, size, spacing, x0=None, tolerance=0.01,
+                            checkpoint_every=10, solution_file=None, **kwargs):
+    '''
+    Re-register after a small change of the inputs, starting from the previous solution instead of x0 = 0.
+    The state file keeps the solution, one content hash and cost per emitter position and the hash of the point
+    set. Only the emitter positions whose geometry or masked projection changed are re-evaluated at the previous
+    pose (all of them if the points changed). If the cost grows by at most tolerance, the previous solution is kept,
+    otherwise it is refined with least_squares, checkpointing the best pose every checkpoint_every evaluations
+    Parameters:
+        state_file (string): JSON state of the previous run (created if missing)
+        u (array): nx3 array of 3D CT source points
+        y (array): ex3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        mask (array): (e, H, W) projection stack from LoadProjectionStack, or a list of image paths
+        x_scale (array): 1x6 array of the parameter scales
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+        x0 (array): 1x6 unscaled start pose when there is no state yet (e.g. LoadSolution of a regSolution file),
+                    defaults to zeros. The stored solution, or the checkpoint of an interrupted run, takes precedence
+        tolerance (float): relative cost increase at the previous pose that is accepted without refinement
+        checkpoint_every (int): evaluations between checkpoints of the refinement
+        solution_file (string): optional regSolution_XX.txt to write the solution to, as the notebook does
+        **kwargs: options passed to least_squares (bounds, max_nfev, ...)
+    Returns:
+        array: 1x6 unscaled solution
+        dict: 'refined' (bool), 'changed_emitters' (indices), 'points_changed' (bool), 'cost' and 'nfev'
+    '''
+    if not isinstance(mask, np.ndarray):
+        mask = func.LoadProjectionStack(mask)
+    x_scale = np.asarray(x_scale, dtype=float)
+    u = np.asarray(u, dtype=float)
+    y = np.asarray(y, dtype=float)
+    mask = mask[:len(y)]
+    state = LoadState(state_file) or {}
+    hashes = EmitterHashes(y, mask)
+    pointsHash = HashArrays(u)
+    previousHashes = state.get('emitter_hashes', [])
+    pointsChanged = state.get('points_hash') != pointsHash
+    if pointsChanged:
+        changed = list(range(len(y)))
+    else:
+        changed = [e for e, h in enumerate(hashes) if e >= len(previousHashes) or previousHashes[e] != h]
+    info = {'refined': False, 'changed_emitters': changed, 'points_changed': pointsChanged, 'nfev': 0}
+    if 'solution' in state:
+        x = np.asarray(state['solution'], dtype=float)
+    elif 'checkpoint' in state:
+        # an interrupted refinement resumes from its progress, even when the first run's x0 is passed again
+        x = np.asarray(state['checkpoint']['x'], dtype=float)
+    else:
+        x = np.zeros(6) if x0 is None else np.asarray(x0, dtype=float)
+    args = (u, y, mask, x_scale, size, spacing)
+
+    if 'solution' in state:
+        if len(changed) == 0 and len(previousHashes) == len(hashes):
+            info['cost'] = float(sum(state['emitter_costs']))
+            return x, info
+        # previous per-emitter costs, with the changed emitter positions re-evaluated at the previous pose
+        costs = np.zeros(len(y))
+        kept = [e for e in range(len(y)) if e not in changed]
+        costs[kept] = np.asarray(state['emitter_costs'])[kept]
+        costs[changed] = EmitterCosts(x*x_scale, u, y[changed], mask[changed], x_scale, size, spacing)
+        # compared per point, the point set may have grown or shrunk
+        previousCost = float(sum(state['emitter_costs']))/state['points']
+        if costs.sum()/len(u) <= (1 + tolerance)*previousCost:
+            state.update(emitter_hashes=hashes, points_hash=pointsHash, points=len(u), emitter_costs=costs.tolist())
+            if state_file is not None:
+                _Save(state_file, state)
+            info['cost'] = float(costs.sum())
+            return x, info
+
+    # refine from the previous pose
+    state.pop('solution', None)
+    residuals = CheckpointedResiduals(func.CT_TomoProjectionRegistrationResiduals, state, state_file, x_scale,
+                                      checkpoint_every)
+    res = least_squares(residuals, x*x_scale, jac=func.CT_TomoProjectionRegistrationResidualsJacobian, args=args,
+                        **kwargs)
+    x = res.x/x_scale
+    costs = EmitterCosts(res.x, *args)
+    state.pop('checkpoint', None)
+    state.update(solution=x.tolist(), x_scale=x_scale.tolist(), emitter_hashes=hashes, points_hash=pointsHash,
+                 points=len(u), emitter_costs=costs.tolist(), nfev=int(res.nfev), status=res.status, time=time.time())
+    if state_file is not None:
+        _Save(state_file, state)
+    if solution_file is not None:
+        np.savetxt(solution_file, x, delimiter=',')
+    info.update(refined=True, cost=float(costs.sum()), nfev=int(res.nfev))
+    return x, info
@@ -0,0 +1,88 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class MemoizedObjective:
+    '''
+    LRU cache around an objective, residual or Jacobian function of the parameter vector.
+    least_squares evaluates the same x more than once (rejected steps, the Jacobian base point, the final
+    evaluation), each miss costs a full projection and sampling sweep while a hit returns the stored value
+    Parameters:
+        fun (function): fun(x, *args, **kwargs), e.g. functions.CT_TomoProjectionRegistration
+        maxsize (int): maximum number of cached evaluations, the least recently used one is dropped first
+        tolerance (float): parameter vectors that round to the same multiple of tolerance share a cache entry,
+                           0 (default) only reuses evaluations of exactly the same x
+    Usage:
+        objective = MemoizedObjective(func.CT_TomoProjectionRegistrationResiduals)
+        jacobian = MemoizedObjective(func.CT_TomoProjectionRegistrationResidualsJacobian)
+        res = least_squares(objective, x0*x_scale, jac=jacobian, args=(u, y, mask_stack, x_scale, size, spacing))
+        print(objective.Stats())
+    '''
+    def __init__(self, fun, maxsize=128, tolerance=0):
+        self.fun = fun
+        self.maxsize = maxsize
+        self.tolerance = tolerance
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def Key(self, x, args=(), kwargs=None):
+        '''
+        Cache key of a parameter vector: its bytes, or the rounded multiples of tolerance, together with the
+        identity of the extra arguments so a wrapper shared between point sets or stacks never mixes them up.
+        Each entry holds the arguments it was computed with, so their ids cannot be reused while it is cached
+        '''
+        x = np.ravel(np.asarray(x, dtype=float))
+        if self.tolerance:
+            x = np.round(x/self.tolerance).astype(np.int64)
+        extra = tuple(id(arg) for arg in args)
+        if kwargs:
+            extra += tuple(sorted((key, id(val)) for key, val in kwargs.items()))
+        return x.tobytes(), extra
+
+    def __call__(self, x, *args, **kwargs):
+        key = self.Key(x, args, kwargs)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and self._Same(entry, args, kwargs):
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._Copy(entry[2])
+            self.misses += 1
+        value = self.fun(x, *args, **kwargs)
+        with self._lock:
+            self._cache[key] = (args, dict(kwargs), self._Copy(value))
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return value
+
+    @staticmethod
+    def _Same(entry, args, kwargs):
+        # the very same argument objects, not just equal ids
+        cachedArgs, cachedKwargs = entry[0], entry[1]
+        return (len(cachedArgs) == len(args) and all(a is b for a, b in zip(cachedArgs, args))
+                and cachedKwargs.keys() == kwargs.keys()
+                and all(cachedKwargs[key] is val for key, val in kwargs.items()))
+
+    @staticmethod
+    def _Copy(value):
+        # the caller may modify a returned array in place, keep the cached value intact
+        return value.copy() if isinstance(value, np.ndarray) else value
+
+    def Stats(self):
+        '''
+        Returns:
+            dict: hits, misses, hit rate and number of cached evaluations
+        '''
+        calls = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits/calls if calls else 0.0,
+                'size': len(self._cache)}
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,211 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import functions as func
+import telemetry
+
+
+# per-process state of the process backend workers, attached once in _InitWorker
+_worker = {}
+
+
+def _Share(array, shared):
+    # copy array into a new shared memory block, appended to shared so the owner can unlink it
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    shared.append(shm)
+    return shm.name, array.shape, array.dtype.str
+
+
+def _Unlink(shared):
+    for shm in shared:
+        shm.close()
+        shm.unlink()
+
+
+def _AttachShared(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _InitWorker(maskSpec, pointSpec, y, size, spacing):
+    maskShm, mask = _AttachShared(maskSpec)
+    pointShm, u = _AttachShared(pointSpec)
+    mask.flags.writeable = False
+    u.flags.writeable = False
+    # keep the SharedMemory handles alive for as long as the worker uses the arrays
+    _worker.update(maskShm=maskShm, pointShm=pointShm, mask=mask, u=u, y=y, size=size, spacing=spacing)
+
+
+def _WorkerValues(start, stop, x, interpolation, policy, penalty):
+    w = _worker
+    return func.SampleCTPoints(x, w['u'], w['y'][start:stop], w['mask'][start:stop], w['size'], w['spacing'],
+                               interpolation, policy=policy, penalty=penalty)
+
+
+def _WorkerJacobian(start, stop, x, policy, penalty):
+    w = _worker
+    return func.SampleCTPointsJacobian(x, w['u'], w['y'][start:stop], w['mask'][start:stop], w['size'], w['spacing'],
+                                       policy=policy, penalty=penalty)
+
+
+def _WorkerRefine(x, x_scale, options):
+    w = _worker
+    return func._RefineCandidate(x, w['u'], w['y'], w['mask'], x_scale, w['size'], w['spacing'], options)
+
+
+def RefineCandidates(candidates, u, y, mask, x_scale, size, spacing, options, workers=None):
+    '''
+    Refine candidate poses with least_squares in worker processes (process backend of functions.GlobalSearch).
+    The projection stack and the points are placed in shared memory once, only the poses are pickled per task
+    Parameters:
+        candidates (array): Kx6 array of the scaled poses to refine
+        u (array): nx3 array of 3D CT source points
+        y (array): ex3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        mask (array): (e, H, W) projection stack
+        x_scale (array): 1x6 array of the parameter scales
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+        options (dict): options passed to every least_squares call
+        workers (int): number of worker processes, defaults to one per candidate
+    Returns:
+        list: least_squares result of every candidate, in candidate order
+    '''
+    shared = []
+    try:
+        maskSpec = _Share(np.ascontiguousarray(mask[:len(y)]), shared)
+        pointSpec = _Share(np.ascontiguousarray(u, dtype=float), shared)
+        with ProcessPoolExecutor(max_workers=workers or len(candidates), initializer=_InitWorker,
+                                 initargs=(maskSpec, pointSpec, np.asarray(y, dtype=float), tuple(size),
+                                           spacing)) as executor:
+            futures = [executor.submit(_WorkerRefine, x, x_scale, options) for x in candidates]
+            return [future.result() for future in futures]
+    finally:
+        _Unlink(shared)
+
+
+class EmitterPool:
+    '''
+    Evaluate the registration objective with the emitter positions split across workers.
+    Every emitter position is independent, so each worker projects and samples the points for its own
+    block of emitter positions and the per-emitter results are concatenated
+    Parameters:
+        u (array): nx3 array of 3D CT source points
+        y (array): ex3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        mask (array): (e, H, W) projection stack from LoadProjectionStack, or a list of image paths
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+        backend (string): 'serial', 'thread' or 'process'. The process backend places the projection stack and
+                          the points in shared memory once, so nothing large is pickled per evaluation
+        workers (int): number of workers, defaults to one per emitter position up to the number of cores
+    Usage:
+        with EmitterPool(u, y, mask_stack, size, spacing, backend='process') as pool:
+            res = least_squares(pool.Residuals, x0*x_scale, jac=pool.ResidualsJacobian, args=(x_scale,))
+    '''
+    def __init__(self, u, y, mask, size, spacing, backend='serial', workers=None):
+        if not isinstance(mask, np.ndarray):
+            mask = func.LoadProjectionStack(mask)
+        self.y = np.asarray(y, dtype=float)
+        self.u = np.ascontiguousarray(u, dtype=float)
+        self.mask = mask[:len(self.y)]
+        self.size = tuple(size)
+        self.spacing = spacing
+        self.backend = backend
+        if workers is None:
+            workers = min(len(self.y), os.cpu_count() or 1)
+        self.workers = 1 if backend == 'serial' else max(1, min(workers, len(self.y)))
+        # contiguous blocks of emitter positions, one task per worker
+        bounds = np.linspace(0, len(self.y), self.workers + 1).astype(int)
+        self.blocks = [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+        self._shared = []
+        self._executor = None
+        if backend == 'thread':
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        elif backend == 'process':
+            maskSpec = self._Share(self.mask)
+            pointSpec = self._Share(self.u)
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_InitWorker,
+                                                 initargs=(maskSpec, pointSpec, self.y, self.size, self.spacing))
+        elif backend != 'serial':
+            raise ValueError("backend must be 'serial', 'thread' or 'process', got {}".format(backend))
+
+    def _Share(self, array):
+        return _Share(array, self._shared)
+
+    def _Map(self, serial, worker, *args):
+        if self.backend == 'serial':
+            return np.concatenate([serial(start, stop, *args) for start, stop in self.blocks])
+        if self.backend == 'thread':
+            futures = [self._executor.submit(serial, start, stop, *args) for start, stop in self.blocks]
+        else:
+            futures = [self._executor.submit(worker, start, stop, *args) for start, stop in self.blocks]
+        return np.concatenate([future.result() for future in futures])
+
+    def _Values(self, start, stop, x, interpolation, policy, penalty):
+        return func.SampleCTPoints(x, self.u, self.y[start:stop], self.mask[start:stop], self.size, self.spacing,
+                                   interpolation, policy=policy, penalty=penalty)
+
+    def _Jacobian(self, start, stop, x, policy, penalty):
+        return func.SampleCTPointsJacobian(x, self.u, self.y[start:stop], self.mask[start:stop], self.size,
+                                           self.spacing, policy=policy, penalty=penalty)
+
+    def SampleCTPoints(self, x, interpolation='bilinear', policy='zero', penalty=0):
+        '''
+        Same as functions.SampleCTPoints for the pool's points, emitter positions and projections
+        Returns:
+            array: exn array of sampled intensities
+        '''
+        return self._Map(self._Values, _WorkerValues, np.asarray(x, dtype=float), interpolation, policy, penalty)
+
+    def SampleCTPointsJacobian(self, x, policy='zero', penalty=0):
+        '''
+        Same as functions.SampleCTPointsJacobian for the pool's points, emitter positions and projections
+        Returns:
+            array: exnx6 array of intensity derivatives
+        '''
+        return self._Map(self._Jacobian, _WorkerJacobian, np.asarray(x, dtype=float), policy, penalty)
+
+    def Residuals(self, x, x_scale, per='pair', interpolation='bilinear', policy='zero', penalty=0):
+        '''
+        Parallel functions.CT_TomoProjectionRegistrationResiduals
+        '''
+        telemetry.Count('evaluations')
+        values = self.SampleCTPoints(x/x_scale, interpolation, policy, -penalty)
+        if per == 'emitter':
+            return 6000 - values.mean(axis=1)
+        return 6000 - values.ravel()
+
+    def ResidualsJacobian(self, x, x_scale, per='pair', interpolation='bilinear', policy='zero', penalty=0):
+        '''
+        Parallel functions.CT_TomoProjectionRegistrationResidualsJacobian
+        '''
+        if interpolation != 'bilinear':
+            raise ValueError("the analytic Jacobian requires bilinear interpolation")
+        telemetry.Count('jacobian_evaluations')
+        jacobian = -self.SampleCTPointsJacobian(x/x_scale, policy, -penalty) / x_scale
+        if per == 'emitter':
+            return jacobian.mean(axis=1)
+        return jacobian.reshape(-1, 6)
+
+    def Objective(self, x, x_scale):
+        '''
+        Parallel functions.CT_TomoProjectionRegistration (scalar, nearest interpolation)
+        '''
+        returnVal = np.mean(self.Residuals(x, x_scale, per='emitter', interpolation='nearest'))
+        telemetry.Cost(returnVal, x/x_scale)
+        return returnVal
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        _Unlink(self._shared)
+        self._shared = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,196 @@
+import numpy as np
+import functions as func
+
+
+def _WeightedChoice(weights, budget, floor, seed):
+    '''
+    Draw budget distinct indices with probability proportional to weights, floor (as a fraction of the mean
+    weight) keeps some points of every part of the vasculature in the subset
+    '''
+    weights = np.asarray(weights, dtype=float)
+    if budget >= len(weights):
+        return np.arange(len(weights))
+    mean = weights.mean()
+    weights = weights + (floor*mean if mean > 0 else 1)
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(len(weights), size=budget, replace=False, p=weights/weights.sum()))
+
+
+def VoxelGridSample(points, budget, iterations=30):
+    '''
+    Keep one point per occupied cell of a regular grid, the point closest to the centroid of the cell.
+    The cell size is searched so that about budget cells are occupied, long straight runs of a vessel
+    then keep roughly one point per cell length instead of one per centerline step
+    Parameters:
+        points (array): nx3 array of 3D points
+        budget (int): target number of points
+        iterations (int): bisection steps of the cell size search
+    Returns:
+        array: sorted indices of the selected points (at most budget)
+    '''
+    points = np.asarray(points, dtype=float)
+    if budget <= 0:
+        return np.empty(0, dtype=np.intp)
+    if budget >= len(points):
+        return np.arange(len(points))
+    low = points.min(axis=0)
+    extent = max(float(np.ptp(points, axis=0).max()), 1e-12)
+    # a cell just larger than the extent holds every point, so the search never ends above budget cells
+    small, large = extent*1e-6, extent*(1 + 1e-9)
+
+    def Cells(cellSize):
+        return np.unique(np.floor((points - low)/cellSize).astype(np.int64), axis=0, return_inverse=True)
+
+    for _ in range(iterations):
+        cellSize = np.sqrt(small*large)
+        if len(Cells(cellSize)[0]) > budget:
+            small = cellSize
+        else:
+            large = cellSize
+    cells, inverse = Cells(large)
+    inverse = inverse.ravel()
+    centroids = np.zeros((len(cells), 3))
+    np.add.at(centroids, inverse, points)
+    centroids /= np.bincount(inverse, minlength=len(cells))[:, np.newaxis]
+    distance = np.sum((points - centroids[inverse])**2, axis=1)
+    order = np.lexsort((distance, inverse))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = inverse[order][1:] != inverse[order][:-1]
+    return np.sort(order[first])
+
+
+def FarthestPointSample(points, budget, start=0):
+    '''
+    Greedy farthest point sampling: every new point is the one farthest from the points selected so far,
+    spreading the subset evenly over the extent of the vasculature
+    Parameters:
+        points (array): nx3 array of 3D points
+        budget (int): number of points
+        start (int): index of the first selected point
+    Returns:
+        array: sorted indices of the selected points
+    '''
+    points = np.asarray(points, dtype=float)
+    if budget <= 0:
+        return np.empty(0, dtype=np.intp)
+    if budget >= len(points):
+        return np.arange(len(points))
+    selected = np.empty(budget, dtype=np.intp)
+    selected[0] = start
+    distance = np.sum((points - points[start])**2, axis=1)
+    for i in range(1, budget):
+        selected[i] = np.argmax(distance)
+        np.minimum(distance, np.sum((points - points[selected[i]])**2, axis=1), out=distance)
+    return np.sort(selected)
+
+
+def RadiusWeightedSample(radii, budget, power=1, floor=0.1, seed=None):
+    '''
+    Random subset favouring wide vessels, which are the most visible in the tomosynthesis projections
+    Parameters:
+        radii (array): nx1 array of the radius of each point (from functions.LoadVesselCenterlines)
+        budget (int): number of points
+        power (float): weights are radius**power
+        floor (float): weight added to every point as a fraction of the mean weight
+        seed (int): random seed
+    Returns:
+        array: sorted indices of the selected points
+    '''
+    return _WeightedChoice(np.asarray(radii, dtype=float)**power, budget, floor, seed)
+
+
+def Curvature(points, offsets):
+    '''
+    Turning angle of the centerline at every point, tube end points (bifurcations and vessel ends) get a right angle
+    Parameters:
+        points (array): nx3 array of centerline points
+        offsets (array): (t+1) array of tube offsets (from functions.LoadVesselCenterlines)
+    Returns:
+        array: nx1 array of angles in radians
+    '''
+    points = np.asarray(points, dtype=float)
+    angles = np.full(len(points), np.pi/2)
+    for start, stop in zip(offsets[:-1], offsets[1:]):
+        if stop - start < 3:
+            continue
+        segments = np.diff(points[start:stop], axis=0)
+        lengths = np.linalg.norm(segments, axis=1)
+        lengths[lengths == 0] = 1
+        segments /= lengths[:, np.newaxis]
+        cosine = np.clip(np.sum(segments[:-1]*segments[1:], axis=1), -1, 1)
+        angles[start+1:stop-1] = np.arccos(cosine)
+    return angles
+
+
+def CurvatureWeightedSample(points, offsets, budget, floor=0.1, seed=None):
+    '''
+    Random subset favouring curved centerline sections and tube ends (bifurcations) over straight runs
+    Parameters:
+        points (array): nx3 array of centerline points
+        offsets (array): (t+1) array of tube offsets (from functions.LoadVesselCenterlines)
+        budget (int): number of points
+        floor (float): weight added to every point as a fraction of the mean weight
+        seed (int): random seed
+    Returns:
+        array: sorted indices of the selected points
+    '''
+    return _WeightedChoice(Curvature(points, offsets), budget, floor, seed)
+
+
+def ProjectedGradientSample(x, u, y, mask, size, spacing, budget, x_scale=None, floor=0.1, seed=None):
+    '''
+    Random subset favouring points whose sampled intensity changes the most with the pose, the norm of the
+    per point rows of the registration Jacobian over all emitter positions
+    Parameters:
+        x (array): 1x6 pose the gradients are evaluated at (unscaled)
+        u (array): nx3 array of 3D CT source points
+        y (array): ex3 array that contains an emitter position per line (most likely one line of the geo.txt file)
+        mask (array): (e, H, W) projection stack, a smoothed stack (functions.MakeProjectionPyramid level or
+                      functions.MakeCostMap) gives gradients to points that land next to the vessels too
+        size (array): 1x3 array of pixel dimensions of tomosynthesis projection image
+        spacing (float): value that decribes the x, y spacing of the CT scan for the purpose of scaling the source points
+        budget (int): number of points
+        x_scale (array): 1x6 parameter scales, the Jacobian is divided by them as in the optimizer
+        floor (float): weight added to every point as a fraction of the mean weight
+        seed (int): random seed
+    Returns:
+        array: sorted indices of the selected points
+    '''
+    if not isinstance(mask, np.ndarray):
+        mask = func.LoadProjectionStack(mask)
+    jacobian = func.SampleCTPointsJacobian(x, u, y, mask, size, spacing)
+    if x_scale is not None:
+        jacobian = jacobian / x_scale
+    return _WeightedChoice(np.sqrt(np.sum(jacobian**2, axis=(0, 2))), budget, floor, seed)
+
+
+def SamplePoints(method, points, budget, **kwargs):
+    '''
+    Select a subset of budget points with one of the strategies
+    Parameters:
+        method (string): 'stride', 'voxel', 'farthest', 'radius', 'curvature' or 'gradient'
+        points (array): nx3 array of 3D points
+        budget (int): number of points
+        **kwargs: strategy options: radii for 'radius', offsets for 'curvature',
+                  x, y, mask, size, spacing for 'gradient' (see the strategy functions)
+    Returns:
+        array: sorted indices of the selected points
+    '''
+    points = np.asarray(points, dtype=float)
+    if budget <= 0:
+        return np.empty(0, dtype=np.intp)
+    if method == 'stride':
+        return np.linspace(0, len(points), min(budget, len(points)), endpoint=False).astype(np.intp)
+    if method == 'voxel':
+        return VoxelGridSample(points, budget, **kwargs)
+    if method == 'farthest':
+        return FarthestPointSample(points, budget, **kwargs)
+    if method == 'radius':
+        return RadiusWeightedSample(kwargs.pop('radii'), budget, **kwargs)
+    if method == 'curvature':
+        return CurvatureWeightedSample(points, kwargs.pop('offsets'), budget, **kwargs)
+    if method == 'gradient':
+        return ProjectedGradientSample(kwargs.pop('x'), points, kwargs.pop('y'), kwargs.pop('mask'),
+                                       kwargs.pop('size'), kwargs.pop('spacing'), budget, **kwargs)
+    raise ValueError("method must be 'stride', 'voxel', 'farthest', 'radius', 'curvature' or 'gradient', got {}"
+                     .format(method))
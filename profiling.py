@@ -0,0 +1,340 @@
+import os
+import json
+import time
+import atexit
+import cProfile
+import functools
+import importlib
+import logging
+import threading
+import tracemalloc
+import numpy as np
+import telemetry
+
+
+logger = logging.getLogger(__name__)
+
+# set to an output prefix to profile a whole run (notebook kernel, batch worker), the files get the process id
+ENVIRONMENT_VARIABLE = 'CTTOMO_PROFILE'
+# comma separated extras of the environment profile: 'memory' (tracemalloc) and 'cprofile'
+OPTIONS_VARIABLE = 'CTTOMO_PROFILE_OPTIONS'
+
+# (module, attribute) of the wrapped functions, class methods as 'Class.method'
+TARGETS = (
+    ('PythonVersorRigid3DPerspectiveTransform', 'VersorRigid3DPerspectiveTransform.TransformPoint'),
+    ('PythonVersorRigid3DPerspectiveTransform', 'VersorRigid3DPerspectiveTransform.TransformPointsMultiEmitter'),
+    ('PythonVersorRigid3DPerspectiveTransform',
+     'VersorRigid3DPerspectiveTransform.ComputeJacobianWithRespectToPositionMultiEmitter'),
+    ('PythonRigid3DTransform', 'RigidMatrix'),
+    ('PythonRigid3DTransform', 'RigidMatrices'),
+    ('PythonRigid3DTransform', 'TransformPoints'),
+    ('itk', 'imread'),
+    ('functions', 'modelCT'),
+    ('functions', 'ProjectCTPoints'),
+    ('functions', 'ProjectCTPointsJacobian'),
+    ('functions', 'SampleProjections'),
+    ('functions', 'LoadProjectionStack'),
+    ('functions', 'RasterizePoints'),
+    ('functions', 'CT_TomoProjectionRegistration'),
+    ('functions', 'CT_TomoProjectionRegistrationResiduals'),
+    ('functions', 'CT_TomoProjectionRegistrationResidualsJacobian'),
+)
+
+# latency histogram bucket edges in seconds, half decades from 1 microsecond to 100 seconds
+HISTOGRAM_EDGES = 10.0**np.arange(-6, 2.5, 0.5)
+# stack frames kept per traced allocation, enough to reach the wrapped function from numpy internals
+TRACE_FRAMES = 32
+
+_active = None
+
+
+class _Record:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = np.inf
+        self.max = 0.0
+        self.histogram = np.zeros(len(HISTOGRAM_EDGES) + 1, dtype=np.int64)
+        self.retained_bytes = 0
+        self.retained_blocks = 0
+
+    def Add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.histogram[np.searchsorted(HISTOGRAM_EDGES, seconds, side='right')] += 1
+
+    def Summary(self):
+        return {'count': self.count, 'total': self.total, 'mean': self.total/max(self.count, 1),
+                'min': self.min if self.count else 0.0, 'max': self.max, 'histogram': self.histogram.tolist(),
+                'retained_bytes': self.retained_bytes, 'retained_blocks': self.retained_blocks}
+
+
+class Profile:
+    '''
+    Opt-in profiling of the hot paths: while active, the TARGETS functions are wrapped to record call counts,
+    cumulative time and a per-call latency histogram, optionally with the memory they retain (tracemalloc) and a
+    cProfile of the whole run. Nothing is wrapped outside of the profile, so it costs nothing when off.
+    Retained memory comes from the difference of the snapshots at the start and the end of the profile: the bytes
+    and blocks allocated since the start and still held at the end, charged to every wrapped function on the
+    stack of the allocation (inclusive, like the times), whichever thread called it
+    Parameters:
+        output (string): optional prefix of the files written on exit: <output>.json (report),
+                         <output>.speedscope.json (timeline of the wrapped calls of the profiling thread, open in
+                         https://www.speedscope.app) and <output>.prof (cProfile, with cprofile)
+        memory (bool): trace allocations with tracemalloc (slows the run down several times), the retained bytes
+                       and blocks per function and the top allocation sites are reported
+        cprofile (bool): also run cProfile over every call of the profiling thread
+        targets (list): (module, attribute) pairs to wrap, defaults to TARGETS
+        max_events (int): calls kept for the speedscope timeline, later calls are only counted
+        top (int): allocation sites in the report
+    Usage:
+        with profiling.Profile(ResultsDir+"profile", memory=True) as profile:
+            res_trf = least_squares(func.CT_TomoProjectionRegistration, ...)
+        print(profile.Report())
+    '''
+    def __init__(self, output=None, memory=False, cprofile=False, targets=TARGETS, max_events=1000000, top=25):
+        self.output = output
+        self.memory = memory
+        self.cprofile = cprofile
+        self.targets = targets
+        self.max_events = max_events
+        self.top = top
+        self.records = {}
+        self.labels = []
+        self.events = []
+        self.allocations = []
+        self.patched = []
+        self.profiler = None
+        self.wall = 0.0
+        self.start = 0.0
+        self.running = False
+        self.baseline = None
+        self.codeRanges = {}
+        self._lock = threading.Lock()
+
+    def _Wrap(self, label, fun):
+        record = self.records.setdefault(label, _Record())
+        if label not in self.labels:
+            self.labels.append(label)
+        frame = self.labels.index(label)
+        events = self.events
+
+        code = getattr(fun, '__code__', None)
+        if code is not None:
+            lines = [line for _, _, line in code.co_lines() if line is not None]
+            self.codeRanges.setdefault(code.co_filename, []).append(
+                (label, code.co_firstlineno, max(lines, default=code.co_firstlineno)))
+
+        @functools.wraps(fun)
+        def Wrapper(*args, **kwargs):
+            # the timeline only follows the profiling thread, so its open and close events always nest
+            timeline = threading.get_ident() == self._thread and len(events) < self.max_events
+            start = time.perf_counter()
+            if timeline:
+                events.append(('O', frame, start))
+            try:
+                return fun(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                if timeline:
+                    events.append(('C', frame, end))
+                with self._lock:
+                    record.Add(end - start)
+        return Wrapper
+
+    def Start(self):
+        self._thread = threading.get_ident()
+        for moduleName, attribute in self.targets:
+            try:
+                owner = importlib.import_module(moduleName)
+                *path, name = attribute.split('.')
+                for part in path:
+                    owner = getattr(owner, part)
+                original = getattr(owner, name)
+            except (ImportError, AttributeError):
+                logger.debug("profiling target %s.%s is not available", moduleName, attribute)
+                continue
+            self.patched.append((owner, name, original))
+            # methods are labelled by their class, functions by their module
+            label = attribute if path else moduleName + "." + attribute
+            setattr(owner, name, self._Wrap(label, original))
+        self._stopTracing = False
+        if self.memory:
+            if tracemalloc.is_tracing():
+                # allocations traced before the profile are not charged to it
+                self.baseline = self._Snapshot()
+            else:
+                tracemalloc.start(TRACE_FRAMES)
+                self._stopTracing = True
+        if self.cprofile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start = time.perf_counter()
+        self.running = True
+        return self
+
+    def Stop(self):
+        if not self.running:
+            # never started, or already stopped
+            return
+        self.running = False
+        self.wall = time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+        if self.memory and tracemalloc.is_tracing():
+            self._Retained(self._Snapshot())
+            self.peak = tracemalloc.get_traced_memory()[1]
+            if self._stopTracing:
+                tracemalloc.stop()
+        if self.output is not None:
+            self.Export(self.output)
+
+    @staticmethod
+    def _Snapshot():
+        # the profile's own bookkeeping is not reported
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__),
+                                                          tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def _Retained(self, snapshot):
+        # (traceback, bytes, blocks) allocated since the start of the profile and still held
+        if self.baseline is None:
+            retained = [(stat.traceback, stat.size, stat.count) for stat in snapshot.statistics('traceback')]
+        else:
+            retained = [(stat.traceback, stat.size_diff, stat.count_diff)
+                        for stat in snapshot.compare_to(self.baseline, 'traceback') if stat.size_diff > 0]
+        self.baseline = None
+        sites = {}
+        for traceback, size, blocks in retained:
+            labels = {label for frame in traceback for label, first, last in self.codeRanges.get(frame.filename, ())
+                      if first <= frame.lineno <= last}
+            for label in labels:
+                record = self.records[label]
+                record.retained_bytes += size
+                record.retained_blocks += max(blocks, 0)
+            site = sites.setdefault((traceback[0].filename, traceback[0].lineno), [0, 0])
+            site[0] += size
+            site[1] += max(blocks, 0)
+        root = os.path.dirname(os.path.abspath(__file__))
+        # allocation sites still holding memory, the repository's own lines first
+        ordered = sorted(sites.items(), key=lambda item: (not item[0][0].startswith(root), -item[1][0]))
+        self.allocations = [{'file': filename, 'line': line, 'bytes': size, 'blocks': blocks}
+                            for (filename, line), (size, blocks) in ordered[:self.top]]
+
+    def __enter__(self):
+        return self.Start()
+
+    def __exit__(self, *exc):
+        self.Stop()
+        return False
+
+    def Stats(self):
+        '''
+        Returns:
+            dict: per wrapped function count, total, mean, min and max seconds, latency histogram and
+                  retained bytes and blocks (with memory), sorted by total time
+        '''
+        with self._lock:
+            stats = {label: record.Summary() for label, record in self.records.items() if record.count}
+        return dict(sorted(stats.items(), key=lambda item: -item[1]['total']))
+
+    def Report(self):
+        '''
+        Returns:
+            string: table of the wrapped functions by total time
+        '''
+        stats = self.Stats()
+        width = max([len('function')] + [len(label) for label in stats])
+        lines = ["{:{}s} {:>9s} {:>10s} {:>11s} {:>6s} {:>12s}".format(
+            'function', width, 'calls', 'total s', 'mean ms', '%wall', 'retained MB')]
+        for label, stat in stats.items():
+            lines.append("{:{}s} {:9d} {:10.4f} {:11.4f} {:6.1f} {:12.2f}".format(
+                label, width, stat['count'], stat['total'], 1e3*stat['mean'], 100*stat['total']/max(self.wall, 1e-12),
+                stat['retained_bytes']/2**20))
+        for site in self.allocations[:10]:
+            lines.append("retained {:10.2f} MB in {:8d} blocks at {}:{}".format(
+                site['bytes']/2**20, site['blocks'], site['file'], site['line']))
+        return "\n".join(lines)
+
+    def Speedscope(self):
+        '''
+        Returns:
+            dict: evented speedscope profile of the wrapped calls of the profiling thread
+        '''
+        events = [{'type': kind, 'frame': frame, 'at': at - self.start} for kind, frame, at in self.events]
+        # calls still open when the event budget ran out are closed at the end
+        open_frames = []
+        for kind, frame, _ in self.events:
+            if kind == 'O':
+                open_frames.append(frame)
+            else:
+                open_frames.pop()
+        end = max(self.wall, events[-1]['at'] if events else 0)
+        events += [{'type': 'C', 'frame': frame, 'at': end} for frame in reversed(open_frames)]
+        return {'$schema': 'https://www.speedscope.app/file-format-schema.json',
+                'shared': {'frames': [{'name': label} for label in self.labels]},
+                'profiles': [{'type': 'evented', 'name': 'registration', 'unit': 'seconds', 'startValue': 0,
+                              'endValue': end, 'events': events}],
+                'name': 'registration', 'exporter': 'profiling.py'}
+
+    def Export(self, output):
+        '''
+        Write <output>.json, <output>.speedscope.json and, with cprofile, <output>.prof
+        '''
+        directory = os.path.dirname(output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        report = {'wall': self.wall, 'histogram_edges': HISTOGRAM_EDGES.tolist(), 'functions': self.Stats(),
+                  'allocations': self.allocations, 'peak_bytes': getattr(self, 'peak', None)}
+        with open(output + ".json", 'w') as f:
+            json.dump(report, f, indent=1)
+        with open(output + ".speedscope.json", 'w') as f:
+            json.dump(self.Speedscope(), f)
+        if self.profiler is not None:
+            self.profiler.dump_stats(output + ".prof")
+        telemetry.Event('profile', output=output, wall=self.wall,
+                        functions={label: stat['total'] for label, stat in report['functions'].items()})
+        logger.info("profile written to %s.*\n%s", output, self.Report())
+
+
+def Start(output=None, **kwargs):
+    '''
+    Start a process wide profile that lasts until Stop() or the end of the process (see Profile)
+    Returns:
+        class: the running Profile
+    '''
+    global _active
+    Stop()
+    _active = Profile(output, **kwargs).Start()
+    return _active
+
+
+def Stop():
+    '''
+    Stop the process wide profile, writing its files
+    Returns:
+        class: the stopped Profile, or None if none was running
+    '''
+    global _active
+    profile, _active = _active, None
+    if profile is not None:
+        profile.Stop()
+    return profile
+
+
+def FromEnvironment():
+    '''
+    Start the process wide profile if CTTOMO_PROFILE is set (called when functions is imported), the output
+    prefix gets the process id so that the workers of a batch do not overwrite each other
+    '''
+    output = os.environ.get(ENVIRONMENT_VARIABLE)
+    if not output or _active is not None:
+        return None
+    options = [option.strip() for option in os.environ.get(OPTIONS_VARIABLE, '').split(',')]
+    profile = Start("{}_{}".format(output, os.getpid()), memory='memory' in options, cprofile='cprofile' in options)
+    atexit.register(Stop)
+    return profile
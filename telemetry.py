@@ -0,0 +1,190 @@
+import json
+import time
+import functools
+import logging
+import threading
+import contextlib
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# module state, every hook returns right away while _enabled is False
+_enabled = False
+_sink = None
+_lock = threading.Lock()
+_stages = {}
+_counters = {}
+_costs = []
+_NULL = contextlib.nullcontext()
+
+
+def Enable(sink=None, level=logging.INFO):
+    '''
+    Turn the instrumentation on, events are logged through the 'telemetry' logger and optionally appended
+    to a JSONL file, one JSON object per line
+    Parameters:
+        sink (string): optional path of the JSONL file
+        level (int): logging level of the events
+    Usage:
+        logging.basicConfig(level=logging.INFO)
+        telemetry.Enable("./Results/telemetry.jsonl")
+        res = least_squares(func.CT_TomoProjectionRegistration, ...)
+        telemetry.Report()
+    '''
+    global _enabled, _sink
+    Disable()
+    Reset()
+    logger.setLevel(level)
+    if sink is not None:
+        _sink = open(sink, 'a')
+    _enabled = True
+
+
+def Disable():
+    global _enabled, _sink
+    _enabled = False
+    if _sink is not None:
+        _sink.close()
+        _sink = None
+
+
+def Enabled():
+    return _enabled
+
+
+def Reset():
+    '''
+    Clear the stage timers, counters and cost trace
+    '''
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        del _costs[:]
+
+
+def _Jsonable(value):
+    # json.dumps default hook, also reached for numpy values nested in lists and dicts
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def Event(name, **fields):
+    '''
+    Log one event and write it to the JSONL sink
+    Parameters:
+        name (string): event name
+        **fields: JSON serializable values (numpy arrays and scalars are converted)
+    '''
+    if not _enabled:
+        return
+    logger.info("%s %s", name, fields)
+    if _sink is not None:
+        record = dict(event=name, time=time.time(), **fields)
+        with _lock:
+            _sink.write(json.dumps(record, default=_Jsonable) + "\n")
+            _sink.flush()
+
+
+class _Stage:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            stage = _stages.setdefault(self.name, [0, 0.0])
+            stage[0] += 1
+            stage[1] += elapsed
+
+
+def Stage(name):
+    '''
+    Context manager that adds the time spent in the block to the stage total
+    Parameters:
+        name (string): stage name ('load', 'transform', 'project', 'sample', 'reduce', ...)
+    '''
+    if not _enabled:
+        return _NULL
+    return _Stage(name)
+
+
+def Timed(name):
+    '''
+    Decorator form of Stage for a whole function
+    '''
+    def Decorator(fun):
+        @functools.wraps(fun)
+        def Wrapper(*args, **kwargs):
+            if not _enabled:
+                return fun(*args, **kwargs)
+            with _Stage(name):
+                return fun(*args, **kwargs)
+        return Wrapper
+    return Decorator
+
+
+def Count(name, n=1):
+    '''
+    Add n to a counter
+    '''
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def Cost(value, x, **fields):
+    '''
+    Record one objective evaluation in the cost trace
+    Parameters:
+        value (float): cost
+        x (array): 1x6 unscaled parameters
+        **fields: additional values of the evaluation (out of bounds count, ...)
+    '''
+    if not _enabled:
+        return
+    with _lock:
+        _costs.append((float(value), np.ravel(x).tolist()))
+        evaluation = len(_costs)
+    Event('cost', evaluation=evaluation, cost=value, x=x, **fields)
+
+
+def Progress(name, i, n):
+    '''
+    Report that item i (0 based) of n of a stage is done
+    '''
+    if not _enabled:
+        return
+    Event('progress', stage=name, done=i+1, total=n)
+
+
+def Summary():
+    '''
+    Returns:
+        dict: 'stages' {name: {'calls', 'seconds'}}, 'counters' {name: value} and 'costs' [(cost, x), ...]
+    '''
+    with _lock:
+        return {'stages': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in _stages.items()},
+                'counters': dict(_counters),
+                'costs': list(_costs)}
+
+
+def Report():
+    '''
+    Log the stage timers and counters as one 'summary' event
+    Returns:
+        dict: Summary()
+    '''
+    summary = Summary()
+    Event('summary', stages=summary['stages'], counters=summary['counters'], evaluations=len(summary['costs']))
+    return summary